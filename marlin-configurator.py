@@ -47,8 +47,34 @@ import stat
 import time
 import logging
 import array
+import bisect
 import re
 import subprocess
+import hashlib
+import tarfile
+import zipfile
+import gzip
+import io
+import filecmp
+import marshal
+import difflib
+import sqlite3
+import mmap
+import shutil
+import glob
+import threading
+import queue
+import ctypes
+import select
+import struct
+import socket
+import email.utils
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import fcntl					# file locking on linux/mac
+except ImportError:
+    fcntl = None
+    import msvcrt					# file locking on windows
 
 #####################################################
 ##### COLOR & FONT SETUP
@@ -65,13 +91,42 @@ repourl = "https://github.com/mydevpeeps/marlin-configurator"
 ctimeout = 60						# connection timeout
 dtimeout = 60						# data transfer timeout
 sslverify = True					# verify ssl cert
-pageDelay = 5						# seconds to delay between page requests
+pageDelay = 5						# slowest pace (seconds per request) when a host throttles us
+fetchrate = 5.0						# requests per second per host to start with
+fetchburst = 10						# requests a host may get back to back
+fetchstate = {}						# per host buckets when there is no cache dir, see fetchToken()
+fetchlock = threading.Lock()		# serializes the buckets between the threads of this run
 errDelay = 5						# seconds to delay between page requests after error
 retries = 5		   					# retry a failed request this # of times (manual attempts)
 sretries = 10	   					# retry a failed request this # of times (per session)
 attempt = 0							# tracker for current iteration of retry
 errcode = 0							# store the response error code
 logfile = "marlin-configurator.log"	# log file
+cachedir = "cache"					# local cache shared by all runs ('None' disables it)
+storemax = 512						# size limit of the example file store in MB
+metricsfile = 'None'				# prometheus textfile-collector output (.prom)
+metricswritten = False				# metrics are only written once per run
+metrics = {}						# counters & gauges, see metricInc()
+histograms = {}						# histograms, see metricObserve()
+metricslock = threading.Lock()		# fleet, worker and prefetch threads update the metrics
+metricbuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+metrichelp = {
+    "directives_total" : "Directives processed by action (enabled, disabled, updated, added, missing).",
+    "files_fetched_total" : "Example files downloaded.",
+    "fetched_bytes_total" : "Bytes downloaded for example files.",
+    "cache_hits_total" : "Example files served from the local cache.",
+    "fetch_retries_total" : "Failed requests that were retried in getWebFile.",
+    "fetch_throttled_total" : "Responses that told us to slow down (429 or an exhausted rate limit).",
+    "fetch_wait_seconds_total" : "Time spent waiting for the fetch scheduler.",
+    "builds_total" : "Firmware builds by result (cached, built, failed).",
+    "fleet_jobs_total" : "Fleet jobs by status (ok, failed).",
+    "files_reset_total" : "Configuration files restored to the pristine Marlin version.",
+    "lock_updates_total" : "Times the example was pinned to a new commit.",
+    "delta_exports_total" : "Exports that only re-applied the options changed since the last export.",
+    "phase_duration_seconds" : "Duration of each phase of the run.",
+    "last_run_exit_code" : "Exit code of the last run.",
+    "last_run_timestamp_seconds" : "Unix time the last run finished."
+}
 today = date.today()
 year = today.year
 
@@ -95,11 +150,35 @@ options_enable = []
 options_disable = []
 options_values = []
 files = ['Configuration.h', 'Configuration_adv.h']
+pendingWrites = {}					# staged file output, see commitWrites()
+storeUsed = {}						# store blobs used by this run, see storeFlush()
+universe = None						# directive names used by the marlin source, see getDirectiveUniverse()
+build = False						# build the firmware after generating the configuration
+buildenv = "None"					# platformio environment to build
+buildcmd = "pio run -e {env}"		# build command, run in targetdir. {env} and {targetdir} are replaced
+buildartifacts = [".pio/build/{env}/firmware*.bin", ".pio/build/{env}/firmware*.hex"]
+marlinrepo = "None"					# local marlin git clone, the source of the fleet worktrees
+jobmem = 1024						# MB of memory to reserve per parallel fleet job
+gitreset = False					# restore the pristine configuration files of the target before applying
+lockfile = True						# pin useExample to a commit in a lockfile next to the JSON, see getExampleLock()
+updatelock = False					# move the pin to the current head of the branch
+archive = "None"					# write the output into this tar/zip (- for a tar on stdout) instead of targetdir
+stream = False						# apply the options with the streaming rewriter, see streamConfigFiles()
+streamed = {}						# target file -> (file to read it from, True if that is a temp file) with --stream
+examplecommit = "None"				# commit the example files were fetched from, when pinned
+branchcommits = {}					# branch -> commit, resolved once per run
+prefetched = {}						# url -> (text, etag, cached) downloaded ahead of time, see startPrefetch()
+prefetcher = None					# the prefetch thread
+prefetchcancel = threading.Event()	# set to stop the prefetch
 f_config = targetdir + "/Marlin/Configuration.h"
-f_config_adv = targetdir + "/Marlin/Configuration_Adv.h"
+f_config_adv = targetdir + "/Marlin/Configuration_adv.h"
 path = "/config/examples/Creality/CR-10 S5/CrealityV1"
 branch = "bugfix-2.0.x"
-URL = "https://raw.githubusercontent.com/MarlinFirmware/Configurations/" + branch + path
+rawurl = "https://raw.githubusercontent.com/MarlinFirmware/Configurations/"
+apiurl = "https://api.github.com/repos/MarlinFirmware/Configurations/"
+URL = rawurl + branch + path
+query = "None"						# search text for --opmode search
+indexmaxage = 24					# hours before a cached example index is refreshed
 
 
 #####################################################
@@ -107,7 +186,8 @@ URL = "https://raw.githubusercontent.com/MarlinFirmware/Configurations/" + branc
 #####################################################
 api_adapter = HTTPAdapter(max_retries=sretries)
 session = requests.Session()
-session.mount(URL,api_adapter)
+session.mount(rawurl,api_adapter)
+session.mount(apiurl,api_adapter)
 
 #####################################################
 ##### LOGGING
@@ -164,9 +244,13 @@ def getErrCode():
 	return errcode
 
 def ExitStageLeft(CODE,MSG):
+    stopPrefetch()
+    writeMetrics(CODE)
     print ()
     ERRORMSG="Exit Code (" + str(CODE) + ") " + str(MSG)
-    sys.exit(ERRORMSG)
+    # sys.exit() with a message always exits with 1, fleet jobs need 0 on success
+    print(ERRORMSG, file=sys.stderr)
+    sys.exit(0 if CODE == 0 else 1)
 
 def intro():
     # intro
@@ -297,7 +381,7 @@ def chDir(d):
 
 def removeROFlag(t):
     try:
-        os.chmod(t,stat.S_IWRITE)
+        os.chmod(t,os.stat(t).st_mode | stat.S_IWRITE)
     except IOError as ioe: ##error message
         print(ioe)
         ExitStageLeft(500,"IOError occured removing read-only flag for  " + str(t))
@@ -357,6 +441,453 @@ def rename(old,new):
         print(e)
         ExitStageLeft(500,"Exception occured renaming " + str(old) + " to " + str(new))
 
+#####################################################
+##### FUNCTIONS - FILE OUTPUT
+#####################################################
+# all output goes through these functions. writes are staged in memory and
+# only hit the disk in commitWrites(), so a crash or ctrl-c mid-run leaves the
+# existing files untouched and files that did not change keep their mtime.
+
+# read a file, preferring the staged (not yet committed) content
+def readFile(f):
+    global pendingWrites
+    if f in pendingWrites:
+        return pendingWrites[f]
+    try:
+        with open(f, "rt", encoding="utf8") as fh:
+            return fh.read()
+    except IOError as ioe: ##error message
+        Message_Exception("IOError Occured reading " + str(f),ioe)
+    except Exception as e: ##error message
+        Message_Exception("Exception Occured reading " + str(f),e)
+
+# stage new content for a file
+def writeFile(f,data):
+    global pendingWrites
+    pendingWrites[f] = str(data)
+
+# true if the file exists on disk or has been staged for writing
+def isFileStaged(f):
+    return f in pendingWrites or isFile(f)
+
+# text mode would translate newlines on write, so do the same before comparing bytes
+def encodeText(data):
+    if os.linesep != "\n":
+        data = data.replace("\n", os.linesep)
+    return data.encode("utf8")
+
+# true if the file on disk already holds exactly these bytes
+def isUnchanged(f,data):
+    try:
+        if os.path.getsize(f) != len(data):
+            return False
+        with open(f, "rb") as fh:
+            return fh.read() == data
+    except OSError:
+        return False
+
+# write bytes to a temp file next to the target, then swap it into place
+def atomicWrite(f,data):
+    tmp = f + ".tmp-" + str(os.getpid())
+    try:
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # keep the permissions of the file we replace
+        if isFile(f) and getPlatform() != "Windows":
+            os.chmod(tmp, stat.S_IMODE(os.stat(f).st_mode))
+        if getPlatform() == "Windows" and isFile(f):
+            removeROFlag(f)			# windows will not replace a read-only file
+        os.replace(tmp, f)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# flush directory entries so the renames survive a power loss (not supported on windows)
+def syncDir(d):
+    if getPlatform() == "Windows":
+        return
+    fd = os.open(d, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# write all staged files to disk. identical files are skipped, files that are
+# in the example store are reflinked from it where the filesystem can, the rest
+# are replaced atomically and each directory is synced once at the end.
+def commitWrites():
+    logger.debug("commitWrites()")
+    global pendingWrites
+    dirs = set()
+    try:
+        for f in sorted(pendingWrites):
+            data = encodeText(pendingWrites[f])
+            h = hashData(data)
+            if isStoreLinked(h,f):
+                # a read-only hard link into the store made by an older version, replace it with a copy
+                if getPlatform() == "Windows":
+                    removeROFlag(f)
+                os.remove(f)
+            elif isUnchanged(f,data):
+                Message_Debug("   Unchanged " + f)
+                continue
+            if storeLink(h,f):
+                Message_Debug("   Linked " + f + " from store")
+            else:
+                Message_Debug("   Writing " + f)
+                atomicWrite(f,data)
+            dirs.add(os.path.dirname(os.path.abspath(f)))
+        for d in sorted(dirs):
+            syncDir(d)
+        pendingWrites = {}
+    except IOError as ioe: ##error message
+        Message_Exception("IOError Occured in commitWrites",ioe)
+        print(ioe)
+    except Exception as e: ##error message
+        Message_Exception("Exception Occured in commitWrites",e)
+        print(e)
+
+#####################################################
+##### FUNCTIONS - EXAMPLE FILE STORE
+#####################################################
+# content-addressed store (sha256 -> blob) under cachedir/store shared by all
+# runs and targets. blobs are read-only and never modified in place. files that
+# are unchanged from the example are reflinked (copy-on-write) into the target
+# where the filesystem supports it, so they share the blocks of the blob but stay
+# writable files of their own. a shared lock is held while adding blobs and
+# an exclusive lock while collecting garbage, so concurrent runs are safe.
+
+# take a lock on a lock file, returns the handle to pass to unlockFile()
+def lockFile(f,shared=False):
+    fh = open(f, "a+")
+    if fcntl:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    else:
+        # windows has no shared locks, so everyone waits for an exclusive one
+        while True:
+            try:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                time.sleep(0.1)
+    return fh
+
+# take a lock only if nobody holds it, returns the handle or None
+def tryLockFile(f):
+    fh = open(f, "a+")
+    try:
+        if fcntl:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        fh.close()
+        return None
+    return fh
+
+def unlockFile(fh):
+    try:
+        if fcntl:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        else:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        fh.close()
+
+def hashData(data):
+    return hashlib.sha256(data).hexdigest()
+
+def storeEnabled():
+    return cachedir != 'None'
+
+def storeDir():
+    return os.path.join(cachedir, "store")
+
+def storePath(h):
+    return os.path.join(storeDir(), "objects", h[:2], h)
+
+def storeLock(shared=False):
+    if not isDir(storeDir()):
+        os.makedirs(os.path.join(storeDir(), "objects"), exist_ok=True)
+    return lockFile(os.path.join(storeDir(), ".lock"), shared)
+
+# remember that this run used a blob (for lru garbage collection)
+def storeTouch(h):
+    global storeUsed
+    storeUsed[h] = time.time()
+
+def storeHas(h):
+    return storeEnabled() and isFile(storePath(h))
+
+# add bytes to the store, returns the hash
+def storePut(data):
+    h = hashData(data)
+    if not storeEnabled():
+        return h
+    storeTouch(h)
+    if isFile(storePath(h)):
+        return h
+    lock = storeLock(shared=True)
+    try:
+        os.makedirs(os.path.dirname(storePath(h)), exist_ok=True)
+        if not isFile(storePath(h)):
+            atomicWrite(storePath(h),data)
+            os.chmod(storePath(h),stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+    finally:
+        unlockFile(lock)
+    return h
+
+# move a file whose hash is h into the store
+def storePutFile(f,h):
+    storeTouch(h)
+    lock = storeLock(shared=True)
+    try:
+        os.makedirs(os.path.dirname(storePath(h)), exist_ok=True)
+        if isFile(storePath(h)):
+            os.remove(f)
+        else:
+            os.chmod(f,stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(f, storePath(h))
+    finally:
+        unlockFile(lock)
+
+# get bytes from the store, None if missing (or removed by another run's gc)
+def storeGet(h):
+    if not storeEnabled():
+        return None
+    try:
+        with open(storePath(h), "rb") as fh:
+            data = fh.read()
+    except OSError:
+        return None
+    if hashData(data) != h:
+        Message_Warning("   Store blob " + h + " is corrupt. Ignoring it.")
+        return None
+    storeTouch(h)
+    return data
+
+# true if f is already the store blob h (same inode)
+def isStoreLinked(h,f):
+    try:
+        return os.path.samefile(storePath(h), f)
+    except OSError:
+        return False
+
+# copy-on-write clone of a file (linux only)
+def reflink(src,dst):
+    if not fcntl or not sys.platform.startswith("linux"):
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+# materialize a blob at f as a reflink, False when the filesystem can not. the
+# target files are not hard linked, that would make them read-only in the user's tree
+def storeLink(h,f):
+    if not storeHas(h):
+        return False
+    tmp = f + ".tmp-" + str(os.getpid())
+    try:
+        if not reflink(storePath(h), tmp):
+            return False
+        if getPlatform() == "Windows" and isFile(f):
+            removeROFlag(f)
+        os.replace(tmp, f)
+        storeTouch(h)
+        return True
+    except OSError as e:
+        logger.debug("storeLink failed for " + str(f) + ": " + str(e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+# url -> {hash, etag} references of downloaded files
+def storeRefs():
+    try:
+        with open(os.path.join(storeDir(), "refs.json"), encoding="utf8") as r:
+            return json.load(r)
+    except (OSError, ValueError):
+        return {}
+
+def storeRef(url):
+    if not storeEnabled():
+        return {}
+    return storeRefs().get(url, {})
+
+def storeSetRef(url,ref):
+    if not storeEnabled():
+        return
+    lock = storeLock()
+    try:
+        refs = storeRefs()
+        refs[url] = ref
+        atomicWrite(os.path.join(storeDir(), "refs.json"), json.dumps(refs, indent=1, sort_keys=True).encode("utf8"))
+    finally:
+        unlockFile(lock)
+
+# record the blobs used by this run and trim the store back under storemax (lru)
+def storeFlush():
+    logger.debug("storeFlush()")
+    global storeUsed
+    if not storeEnabled() or not isDir(storeDir()):
+        return
+    lock = storeLock()
+    try:
+        lrufile = os.path.join(storeDir(), "lru.json")
+        try:
+            with open(lrufile, encoding="utf8") as r:
+                lru = json.load(r)
+        except (OSError, ValueError):
+            lru = {}
+        lru.update(storeUsed)
+
+        # find every blob with its size and last use
+        blobs = []
+        total = 0
+        for root, dirs, names in os.walk(os.path.join(storeDir(), "objects")):
+            for h in names:
+                if ".tmp-" in h:
+                    continue
+                size = os.path.getsize(os.path.join(root, h))
+                blobs.append((lru.get(h, 0), h, size))
+                total += size
+
+        # drop the least recently used blobs until we fit
+        limit = storemax * 1024 * 1024
+        for used, h, size in sorted(blobs):
+            if total <= limit:
+                break
+            Message_Debug("   Store removing " + h)
+            os.chmod(storePath(h), stat.S_IREAD | stat.S_IWRITE)
+            os.remove(storePath(h))
+            lru.pop(h, None)
+            total -= size
+        present = set(h for used, h, size in blobs)
+        lru = dict((h, t) for h, t in lru.items() if h in present and isFile(storePath(h)))
+        atomicWrite(lrufile, json.dumps(lru, sort_keys=True).encode("utf8"))
+
+        # parsed directives live as long as the blob they were parsed from
+        for f in glob.glob(os.path.join(cachedir, "parsed", "*", "*")):
+            if ".tmp-" not in f and not isFile(storePath(os.path.basename(f))):
+                os.remove(f)
+        storeUsed = {}
+    except IOError as ioe: ##error message
+        Message_Exception("IOError Occured in storeFlush",ioe)
+    except Exception as e: ##error message
+        Message_Exception("Exception Occured in storeFlush",e)
+    finally:
+        unlockFile(lock)
+
+#####################################################
+##### FUNCTIONS - METRICS
+#####################################################
+# counters and histograms for the run, written out in the prometheus
+# textfile-collector format by writeMetrics() when the run ends
+
+# key for a metric series, labels are kept sorted so the output is stable
+def metricKey(name,labels=None):
+    return (name, tuple(sorted((labels or {}).items())))
+
+# add to a counter
+def metricInc(name,value=1,labels=None):
+    global metrics
+    key = metricKey(name,labels)
+    with metricslock:
+        metrics[key] = metrics.get(key,0) + value
+
+# set a gauge
+def metricSet(name,value,labels=None):
+    global metrics
+    with metricslock:
+        metrics[metricKey(name,labels)] = value
+
+# record an observation in a histogram
+def metricObserve(name,value,labels=None):
+    global histograms
+    key = metricKey(name,labels)
+    with metricslock:
+        if key not in histograms:
+            histograms[key] = {"buckets": [0] * len(metricbuckets), "sum": 0.0, "count": 0}
+        h = histograms[key]
+        for i, le in enumerate(metricbuckets):
+            if value <= le:
+                h["buckets"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+# run one phase of main() and record how long it took
+def timePhase(phase,func):
+    start = time.monotonic()
+    try:
+        return func()
+    finally:
+        metricObserve("phase_duration_seconds", time.monotonic() - start, {"phase": phase})
+
+# render the label set of a series
+def metricLabels(labels):
+    labels = (("config", os.path.basename(JSONFile)),) + labels
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(k + "=\"" + v + "\"")
+    return "{" + ",".join(parts) + "}"
+
+# write the collected metrics to the textfile collector file
+def writeMetrics(code):
+    global metricsfile
+    global metricswritten
+    if metricsfile == 'None' or metricswritten:
+        return
+    metricswritten = True
+    prefix = "marlin_configurator_"
+    out = []
+    for action in ['enabled','disabled','updated','added','missing']:
+        metricInc("directives_total", 0, {"action": action})
+    for name in ['files_fetched_total','fetched_bytes_total','cache_hits_total','fetch_retries_total']:
+        metricInc(name, 0)
+    metricSet("last_run_exit_code", code)
+    metricSet("last_run_timestamp_seconds", round(time.time(),3))
+    types = {}
+    for (name, labels) in metrics:
+        types.setdefault(name, []).append(labels)
+    for name in sorted(types):
+        kind = "gauge" if name.startswith("last_run_") else "counter"
+        out.append("# HELP " + prefix + name + " " + metrichelp.get(name, name.replace("_"," ")))
+        out.append("# TYPE " + prefix + name + " " + kind)
+        for labels in sorted(types[name]):
+            out.append(prefix + name + metricLabels(labels) + " " + str(metrics[(name, labels)]))
+    names = sorted(set(name for (name, labels) in histograms))
+    for name in names:
+        out.append("# HELP " + prefix + name + " " + metrichelp.get(name, name.replace("_"," ")))
+        out.append("# TYPE " + prefix + name + " histogram")
+        for (hname, labels) in sorted(histograms):
+            if hname != name:
+                continue
+            h = histograms[(hname, labels)]
+            for i, le in enumerate(metricbuckets):
+                out.append(prefix + name + "_bucket" + metricLabels(labels + (("le", str(le)),)) + " " + str(h["buckets"][i]))
+            out.append(prefix + name + "_bucket" + metricLabels(labels + (("le", "+Inf"),)) + " " + str(h["count"]))
+            out.append(prefix + name + "_sum" + metricLabels(labels) + " " + str(round(h["sum"],6)))
+            out.append(prefix + name + "_count" + metricLabels(labels) + " " + str(h["count"]))
+    try:
+        atomicWrite(metricsfile, "\n".join(out).encode("utf8") + b"\n")
+    except Exception as e: ##error message
+        # never let a metrics failure change the outcome of the run
+        Message_Error("Unable to write metrics to " + str(metricsfile) + ": " + str(e))
+        logger.exception(e)
+
 #####################################################
 ##### FUNCTIONS - JSON PARSING
 #####################################################
@@ -411,6 +942,14 @@ def getJSONSettings():
     global JSONFile
     global f_config
     global f_config_adv
+    global metricsfile
+    global cachedir
+    global build
+    global buildenv
+    global buildcmd
+    global gitreset
+    global lockfile
+    global stream
 
     try:
         if isFile(JSONFile):
@@ -436,9 +975,57 @@ def getJSONSettings():
                                 targetdir = sdata['targetdir']
                                 Message_Config("  targetdir: " + str(targetdir))
                                 f_config = targetdir + "/Marlin/Configuration.h"
-                                f_config_adv = targetdir + "/Marlin/Configuration_Adv.h"
+                                f_config_adv = targetdir + "/Marlin/Configuration_adv.h"
                             else:
                                 Message_Error("JSON setting targetdir is missing a value")
+                        if "metrics" in sdata:
+                            if not (sdata.get('metrics') is None):
+                                metricsfile = sdata['metrics']
+                                Message_Config("  metrics: " + str(metricsfile))
+                            else:
+                                Message_Error("JSON setting metrics is missing a value")
+                        if "cachedir" in sdata:
+                            if not (sdata.get('cachedir') is None):
+                                cachedir = sdata['cachedir']
+                                Message_Config("  cachedir: " + str(cachedir))
+                            else:
+                                Message_Error("JSON setting cachedir is missing a value")
+                        if "build" in sdata:
+                            if not (sdata.get('build') is None):
+                                build = sdata['build']
+                                Message_Config("  build: " + str(build))
+                            else:
+                                Message_Error("JSON setting build is missing a value")
+                        if "buildenv" in sdata:
+                            if not (sdata.get('buildenv') is None):
+                                buildenv = sdata['buildenv']
+                                Message_Config("  buildenv: " + str(buildenv))
+                            else:
+                                Message_Error("JSON setting buildenv is missing a value")
+                        if "buildcmd" in sdata:
+                            if not (sdata.get('buildcmd') is None):
+                                buildcmd = sdata['buildcmd']
+                                Message_Config("  buildcmd: " + str(buildcmd))
+                            else:
+                                Message_Error("JSON setting buildcmd is missing a value")
+                        if "gitreset" in sdata:
+                            if not (sdata.get('gitreset') is None):
+                                gitreset = sdata['gitreset']
+                                Message_Config("  gitreset: " + str(gitreset))
+                            else:
+                                Message_Error("JSON setting gitreset is missing a value")
+                        if "lockfile" in sdata:
+                            if not (sdata.get('lockfile') is None):
+                                lockfile = sdata['lockfile']
+                                Message_Config("  lockfile: " + str(lockfile))
+                            else:
+                                Message_Error("JSON setting lockfile is missing a value")
+                        if "stream" in sdata:
+                            if not (sdata.get('stream') is None):
+                                stream = sdata['stream']
+                                Message_Config("  stream: " + str(stream))
+                            else:
+                                Message_Error("JSON setting stream is missing a value")
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in getJSONSettings",ioe)
         print(ioe)
@@ -477,6 +1064,7 @@ def getJSONConfig():
                                 Message_Config("  path: " + str(path))
                             else:
                                 Message_Error("JSON useExample path is missing a value")
+                        URL = exampleURL(branch,path)
                         if "files" in sdata:
                             if not (sdata.get('files') is None):
                                 files = sdata['files']
@@ -508,7 +1096,7 @@ def getJSONOptions():
     global options_values
 
     f_config = targetdir + "/Marlin/Configuration.h"
-    f_config_adv = targetdir + "/Marlin/Configuration_Adv.h"
+    f_config_adv = targetdir + "/Marlin/Configuration_adv.h"
     Message_Config("   Using " + f_config)
     Message_Config("   Using " + f_config_adv)
 
@@ -539,6 +1127,120 @@ def getJSONOptions():
         print(e)
 
 
+#####################################################
+##### FUNCTIONS - FETCH SCHEDULER
+#####################################################
+# every request to a host takes a token from that host's bucket first. the
+# buckets live in cachedir/ratelimit.json under an exclusive lock, so the
+# prefetch thread, fleet workers and any other run sharing the cache draw from
+# the same budget. the rate grows slowly while requests succeed and is halved
+# (down to one request every pageDelay seconds) when a host answers 429 or runs
+# out of X-RateLimit-Remaining. Retry-After / X-RateLimit-Reset block the host
+# until that time for everyone.
+
+def fetchHost(url):
+    return url.split("://", 1)[-1].split("/", 1)[0].lower()
+
+# run fn on the bucket of a host while holding the locks, returns what fn returns
+def fetchBucket(host,fn):
+    with fetchlock:
+        if not storeEnabled():
+            b = fetchstate.setdefault(host, {})
+            return fn(b)
+        os.makedirs(cachedir, exist_ok=True)
+        lock = lockFile(os.path.join(cachedir, "ratelimit.lock"))
+        try:
+            f = os.path.join(cachedir, "ratelimit.json")
+            try:
+                with open(f, "rt") as fh:
+                    state = json.load(fh)
+            except (OSError, ValueError):
+                state = {}
+            b = state.setdefault(host, {})
+            ret = fn(b)
+            atomicWrite(f, json.dumps(state).encode("utf8"))	# a reader never sees half a file
+            return ret
+        finally:
+            unlockFile(lock)
+
+# wait for a token for the host of url. returns False when cancel was set while
+# waiting, or without waiting when it would take more than maxwait seconds
+def fetchToken(url,cancel=None,maxwait=None):
+    host = fetchHost(url)
+    def take(b):
+        now = time.time()
+        b.setdefault('rate', float(fetchrate))
+        b['tokens'] = min(float(fetchburst), b.get('tokens', float(fetchburst)) + (now - b.get('stamp', now)) * b['rate'])
+        b['stamp'] = now
+        if b.get('until', 0) > now:
+            return b['until'] - now
+        if b['tokens'] >= 1:
+            b['tokens'] -= 1
+            return 0
+        return (1 - b['tokens']) / b['rate']
+    waited = 0
+    while True:
+        wait = fetchBucket(host, take)
+        if wait <= 0:
+            break
+        if maxwait is not None and waited + wait > maxwait:
+            logger.info(host + " is rate limited for " + str(int(wait + 0.5)) + " seconds, not waiting")
+            return False
+        if wait > errDelay and waited == 0:
+            Message_Warning("   " + host + " is rate limiting requests, waiting " + str(int(wait + 0.5)) + " seconds")
+        waited += wait
+        if cancel is not None:
+            if cancel.wait(wait):
+                return False
+        else:
+            time.sleep(wait)
+    if waited:
+        metricInc("fetch_wait_seconds_total", waited)
+    return True
+
+# adjust the bucket of a host from the answer it gave
+def fetchFeedback(url,r):
+    h = r.headers
+    now = time.time()
+    remaining = h.get('X-RateLimit-Remaining')
+    reset = h.get('X-RateLimit-Reset')
+    throttled = r.status_code == 429 or (r.status_code == 403 and remaining == "0")
+    def adjust(b):
+        rate = b.get('rate', float(fetchrate))
+        if throttled:
+            until = now + pageDelay
+            after = h.get('Retry-After')
+            if after:
+                try:
+                    until = now + float(after)
+                except ValueError:
+                    when = email.utils.parsedate_tz(after)
+                    if when:
+                        until = email.utils.mktime_tz(when)
+            elif remaining == "0" and reset and reset.isdigit():
+                until = float(reset)
+            b['until'] = max(b.get('until', 0), until)
+            b['tokens'] = 0
+            b['rate'] = max(1.0 / pageDelay, rate / 2)
+        else:
+            b['rate'] = min(float(fetchrate) * 4, rate + 0.1)
+            # spread what is left of the window over the time until it resets
+            if remaining and reset and remaining.isdigit() and reset.isdigit() and float(reset) > now:
+                b['rate'] = max(1.0 / pageDelay, min(b['rate'], int(remaining) / (float(reset) - now)))
+    if throttled:
+        metricInc("fetch_throttled_total")
+        logger.warning(fetchHost(url) + " answered " + str(r.status_code) + ", slowing down")
+    fetchBucket(fetchHost(url), adjust)
+
+# session.get() paced by the fetch scheduler, None when cancel was set while waiting
+# or the host is blocked for longer than maxwait (for lookups we can do without)
+def fetch(url,headers,cancel=None,stream=False,maxwait=None):
+    if not fetchToken(url, cancel, maxwait):
+        return None
+    r = session.get(url = url, headers = headers, verify=sslverify, timeout=(ctimeout,dtimeout), stream=stream)
+    fetchFeedback(url, r)
+    return r
+
 #####################################################
 ##### FUNCTIONS - WEB REQUESTS
 #####################################################
@@ -548,19 +1250,66 @@ def getExampleFiles():
     global path
     global files
     global URL
+    global examplecommit
 
     try:
         # sanitize targetdir first
         if pathExists(targetdir):
             removeROFlag(targetdir)
+
+        # let the background prefetch finish, getWebFile() picks up what it downloaded
+        waitPrefetch()
+
+        # pinned files come from the commit, and straight from the store when we have them
+        lock = getExampleLock() if lockfile else {}
+        base = exampleURL(lock['commit'],path) if lock else URL
+        hashes = {}
+        skipped = []
         for name in files:
-            Message_Config("     downloading " + str(name) + " from " + URL + " to " + str(targetdir) + "/Marlin")
-            furl = URL + "/" + name
             lfilename = targetdir + "/Marlin/" + name
+            h = lock.get('files', {}).get(name)
+            if stream:
+                # read straight from the store or the download later, see streamConfigFiles()
+                if h and storeHas(h):
+                    metricInc("cache_hits_total")
+                    Message_Config("     using " + str(name) + " " + h[:12] + " (pinned) from the store")
+                    storeTouch(h)
+                    streamed[lfilename] = (storePath(h), False)
+                    hashes[name] = h
+                    continue
+                Message_Config("     downloading " + str(name) + " from " + base + " to " + str(targetdir) + "/Marlin")
+                got = streamDownload(base + "/" + name, lfilename)
+                if lock and h and got != h:
+                    ExitStageLeft(500,str(name) + " at " + lock['commit'] + " does not match its hash in " + lockFilePath() + ". Use --update-lock True to pin it again.")
+                hashes[name] = got
+                continue
+            data = storeGet(h) if h else None
+            if data is not None:
+                metricInc("cache_hits_total")
+                Message_Config("     using " + str(name) + " " + h[:12] + " (pinned) from the store")
+                writeFile(lfilename,data.decode("utf8", "replace"))
+                hashes[name] = h
+                continue
+            Message_Config("     downloading " + str(name) + " from " + base + " to " + str(targetdir) + "/Marlin")
+            text = getWebFile(base + "/" + name)
+            if text is None:
+                Message_Warning("     skipping " + str(name))
+                skipped.append(name)
+                continue
+            if lock:
+                # getWebFile() only returns the body of a 200 (or the stored blob after a 304)
+                got = storePut(text.encode("utf8"))
+                if h and got != h:
+                    ExitStageLeft(500,str(name) + " at " + lock['commit'] + " does not match its hash in " + lockFilePath() + ". Use --update-lock True to pin it again.")
+                hashes[name] = got
             #rmFile(lfilename) # remove old file first .. NO CACHING!
-            lfile=open(lfilename, mode="w", encoding="utf-8")
-            lfile.write(getWebFile(furl))
-            lfile.close()
+            writeFile(lfilename,text)
+        if lock and skipped:
+            Message_Warning("   Not pinning " + lockFilePath() + ", " + ", ".join(skipped) + " could not be downloaded")
+        elif lock:
+            lock['files'] = hashes
+            writeLock(lock)
+            examplecommit = lock['commit']
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in getExampleFiles",ioe)
         print(ioe)
@@ -568,7 +1317,7 @@ def getExampleFiles():
         Message_Exception("Exception Occured in getExampleFiles",e)
         print(e)
 
-# gets one file at a time from the internet
+# gets one file at a time from the internet. None when the user skips a missing file
 def getWebFile(URL):
     global attempt
     global version
@@ -582,9 +1331,31 @@ def getWebFile(URL):
         'User-Agent': 'Marlin Configurator v' + version
     }
 
+    # downloaded while the prompts were waiting
+    hit = takePrefetched(URL)
+    if hit is not None and hit[2]:
+        metricInc("cache_hits_total")
+        Message_Debug("     " + URL + " not modified (prefetch), using the store")
+        return hit[0]
+    if hit is not None:
+        data = hit[0].encode("utf8")
+        metricInc("files_fetched_total")
+        metricInc("fetched_bytes_total", len(data))
+        storeSetRef(URL, {"hash": storePut(data), "etag": hit[1]})
+        Message_Debug("     " + URL + " was prefetched")
+        return hit[0]
+
+    # if we have the file in the store ask the server if it changed instead of downloading it again
+    ref = storeRef(URL)
+    cached = None
+    if ref.get('etag'):
+        cached = storeGet(ref['hash'])
+        if cached is not None:
+            HEADERS['If-None-Match'] = ref['etag']
+
     for rt in range(1,retries+1):
         try: 
-            r = session.get(url = URL, headers = HEADERS, verify=sslverify, timeout=(ctimeout,dtimeout))
+            r = fetch(URL, HEADERS)
             r.encoding = 'utf-8'
             r.raise_for_status()
         except Timeout as t:
@@ -592,19 +1363,17 @@ def getWebFile(URL):
             logger.exception(t)
             logger.critical('Query Timed Out')
         except HTTPError as e:
-            if errorCode == 404:
+            if r.status_code == 404 and URL.startswith(rawurl):
                 Message_Warning("   Configuration Example File Not Found at " + URL)
                 Message_Warning("   Confirm file exists. Adjust JSON Configuration if file is invalid.")
+                suggestExamplePaths()
                 if mode == "interactive":
                     oktogo = multi_choice_question(['abort','continue'],'Continue or Abort ? ','Missing Source File')    
                     if oktogo == "abort":
                         ExitStageLeft(404,"Missing Configuration File. User Cancelled.")
-                    else:
-                        attempt = 1
-                        break
-                else:
                     attempt = 1
-                    break
+                    return None	# skip the file, the body of a 404 is not a configuration
+                ExitStageLeft(404,"Configuration Example File Not Found at " + URL)
             else:
                 errorCode = r.status_code
             logger.critical('Query Error')
@@ -624,6 +1393,9 @@ def getWebFile(URL):
             logger.exception(err)
         else:
             errorCode = 0
+            if r.status_code != 304:
+                metricInc("files_fetched_total")
+                metricInc("fetched_bytes_total", len(r.content))
             logger.debug("Request URL: " + str(r.request.url))
             logger.debug("Request Headers: " + str(r.request.headers))
             logger.debug("Response Code: " + str(r.status_code))
@@ -637,8 +1409,11 @@ def getWebFile(URL):
             msg = "attempt " + str(rt) + " of " + str(retries) + " for initial request failed with response code " + str(getErrCode())
             logger.warning(msg)
             attempt += 1
-            logger.info("sleeping for " + str(errDelay) + "seconds")
-            time.sleep(errDelay)
+            metricInc("fetch_retries_total")
+            # a throttled host already blocked its bucket, fetchToken() waits for it
+            if errorCode != 429:
+                logger.info("sleeping for " + str(errDelay) + "seconds")
+                time.sleep(errDelay)
 
         # error out if there was a problem with the initial request
         if attempt == retries:
@@ -647,10 +1422,416 @@ def getWebFile(URL):
             print (msg)
             setErrCode(0)
             attempt=1
+            writeMetrics(errorCode)
             sys.exit(msg)
 
+    if r.status_code == 304:
+        metricInc("cache_hits_total")
+        Message_Debug("     " + URL + " not modified, using the store")
+        return cached.decode("utf8", "replace")
+    if r.status_code != 200:
+        ExitStageLeft(r.status_code,"Unable to download " + URL + " (response code " + str(r.status_code) + ")")
+    storeSetRef(URL, {"hash": storePut(r.content), "etag": r.headers.get('ETag', "")})
     return str(r.text)
 
+#####################################################
+##### FUNCTIONS - EXAMPLE LOCKFILE
+#####################################################
+# the lockfile next to the JSON pins useExample.branch to a commit and records
+# the hash of every example file. files are then fetched by commit, which never
+# changes, so once they are in the store they are used without asking the
+# server at all and the same JSON keeps producing the same headers.
+# --update-lock moves the pin to the current head of the branch.
+
+def lockFilePath():
+    return os.path.splitext(JSONFile)[0] + ".lock"
+
+# the current lock, empty if there is none (or it is unreadable)
+def readLock(report=True):
+    try:
+        with open(lockFilePath(), encoding="utf8") as r:
+            lock = json.load(r)
+        if re.fullmatch("[0-9a-f]{40}", str(lock.get('commit'))):
+            return lock
+        if report:
+            Message_Warning("   " + lockFilePath() + " has no valid commit. Ignoring it.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        if report:
+            Message_Warning("   Unable to read " + lockFilePath() + ": " + str(e))
+    return {}
+
+# write the lock, only if it changed
+def writeLock(lock):
+    data = (json.dumps(lock, indent=1, sort_keys=True) + "\n").encode("utf8")
+    if not isUnchanged(lockFilePath(), data):
+        Message_Config("   Writing " + lockFilePath())
+        atomicWrite(lockFilePath(), data)
+
+# the commit a branch points to now, None on failure. remembered for the rest of
+# the run, so the prefetch and the export resolve it only once
+def getBranchCommit(b,report=True):
+    if b in branchcommits:
+        return branchcommits[b]
+    HEADERS = {'User-Agent': 'Marlin Configurator v' + version, 'Accept': 'application/vnd.github.sha'}
+    if os.environ.get('GITHUB_TOKEN'):
+        HEADERS['Authorization'] = 'Bearer ' + os.environ['GITHUB_TOKEN']
+    try:
+        r = fetch(apiurl + "commits/" + b, HEADERS, maxwait=errDelay)	# unpinned is the fallback
+        if r is None:
+            raise Exception(fetchHost(apiurl) + " is rate limited")
+        r.raise_for_status()
+        sha = r.text.strip()
+        if re.fullmatch("[0-9a-f]{40}", sha):
+            branchcommits[b] = sha
+            return sha
+        if report:
+            Message_Error("Unexpected answer resolving branch " + str(b) + ": " + sha[:80])
+    except Exception as e: ##error message
+        if report:
+            Message_Error("Unable to resolve branch " + str(b) + " to a commit: " + str(e))
+        logger.exception(e)
+    return None
+
+# the lock to fetch the example with, empty to fetch the branch unpinned
+def getExampleLock():
+    logger.debug("getExampleLock()")
+    lock = readLock()
+    if lock and not updatelock:
+        if lock.get('branch') == branch and lock.get('path') == path:
+            Message_Config("   " + branch + " is pinned to " + lock['commit'][:12] + " by " + lockFilePath())
+            return lock
+        Message_Warning("   useExample changed since " + lockFilePath() + " was written. Pinning it again.")
+    sha = getBranchCommit(branch)
+    if sha is None:
+        if lock and lock.get('branch') == branch and lock.get('path') == path:
+            Message_Warning("   Keeping the pin to " + lock['commit'][:12])
+            return lock
+        Message_Warning("   Using " + branch + " unpinned. The result may change when the branch moves.")
+        return {}
+    if lock.get('commit') == sha and lock.get('path') == path:
+        Message_Config("   " + branch + " is still at " + sha[:12])
+        lock['branch'] = branch		# useExample may name the same commit by another branch, written by getExampleFiles()
+        return lock
+    Message_Config("   Pinned " + branch + " to " + sha[:12])
+    metricInc("lock_updates_total")
+    return {"branch": branch, "path": path, "commit": sha, "files": {}}
+
+#####################################################
+##### FUNCTIONS - EXAMPLE PREFETCH
+#####################################################
+# in interactive mode the settings conflicts are resolved with prompts before
+# anything is downloaded. the example files only depend on useExample, so they
+# are fetched in a background thread while the prompts wait for an answer. the
+# results stay in memory until getExampleFiles() asks for them; nothing is
+# written, so an abort just drops them. failures are ignored here and reported
+# by the normal download that follows.
+
+# the urls getExampleFiles() will request, skipping pinned files already in the store
+def prefetchURLs():
+    lock = readLock(report=False) if lockfile else {}
+    pinned = lock and not updatelock and lock.get('branch') == branch and lock.get('path') == path
+    if pinned:
+        base = exampleURL(lock['commit'],path)
+    elif lockfile:
+        sha = getBranchCommit(branch,report=False)
+        base = exampleURL(sha,path) if sha else URL
+    else:
+        base = URL
+    urls = []
+    for name in files:
+        h = lock.get('files', {}).get(name) if pinned else None
+        if not (h and storeHas(h)):
+            urls.append(base + "/" + name)
+    return urls
+
+# download the example files into prefetched, stopping early when cancelled
+def prefetchExampleFiles(cancel):
+    HEADERS = {'User-Agent': 'Marlin Configurator v' + version, 'Cache-Control': 'no-cache'}
+    try:
+        for url in prefetchURLs():
+            if cancel.is_set():
+                return
+            ref = storeRef(url)
+            headers = dict(HEADERS)
+            if ref.get('etag') and storeHas(ref.get('hash', "")):
+                headers['If-None-Match'] = ref['etag']
+            r = fetch(url, headers, cancel)
+            if r is None:
+                return
+            if r.status_code == 200:
+                r.encoding = 'utf-8'
+                prefetched[url] = (str(r.text), r.headers.get('ETag', ""), False)
+            elif r.status_code == 304:
+                data = storeGet(ref['hash'])
+                if data is not None:
+                    prefetched[url] = (data.decode("utf8", "replace"), ref['etag'], True)
+    except Exception as e: ##error message
+        logger.debug("prefetch stopped: " + str(e))
+
+# start fetching the example files in the background
+def startPrefetch():
+    global prefetcher
+    prefetcher = threading.Thread(target=prefetchExampleFiles, args=(prefetchcancel,), name="prefetch", daemon=True)
+    prefetcher.start()
+
+# wait for the prefetch to finish (it is fetching the files we are about to need)
+def waitPrefetch():
+    global prefetcher
+    if prefetcher is not None:
+        prefetcher.join()
+        prefetcher = None
+
+# stop the prefetch before its next request and drop what it fetched (on exit or abort)
+def stopPrefetch():
+    prefetchcancel.set()
+    prefetched.clear()
+
+# a prefetched file as (text, etag, True if it came from the store after a 304), or None
+def takePrefetched(url):
+    return prefetched.pop(url, None)
+
+#####################################################
+##### FUNCTIONS - EXAMPLE SEARCH
+#####################################################
+# every example path of a branch is kept in cachedir/index/<branch>.json together
+# with its trigram index, so fuzzy queries like "ender3 v2 skr" are answered
+# locally without browsing github or indexing the paths again.
+
+# useExample.path is relative to config/examples unless it starts with config/
+def examplePath(p):
+    p = str(p).strip("/")
+    if p.startswith("config/"):
+        return "/" + p
+    return "/config/examples/" + p
+
+def exampleURL(b,p):
+    return rawurl + b + examplePath(p)
+
+# lower case and drop everything but letters & digits, so "CR-10 S5" == "cr10s5"
+def squash(text):
+    return "".join(re.findall("[a-z0-9]+", str(text).lower()))
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+# get the list of example paths of a branch from github, None on failure. maxwait
+# as in fetch()
+def getExampleTree(b,maxwait=None):
+    HEADERS = {'User-Agent': 'Marlin Configurator v' + version, 'Accept': 'application/vnd.github+json'}
+    if os.environ.get('GITHUB_TOKEN'):
+        HEADERS['Authorization'] = 'Bearer ' + os.environ['GITHUB_TOKEN']
+    try:
+        r = fetch(apiurl + "git/trees/" + b + "?recursive=1", HEADERS, maxwait=maxwait)
+        if r is None:
+            raise Exception(fetchHost(apiurl) + " is rate limited")
+        r.raise_for_status()
+        tree = r.json()
+    except Exception as e: ##error message
+        Message_Error("Unable to get the list of examples for branch " + str(b) + ": " + str(e))
+        logger.exception(e)
+        return None
+    if tree.get('truncated'):
+        Message_Warning("The example list for " + str(b) + " is truncated. Some paths will be missing.")
+    paths = set()
+    for item in tree.get('tree', []):
+        p = item.get('path', "")
+        if item.get('type') == "blob" and p.startswith("config/") and p.endswith("/Configuration.h"):
+            p = os.path.dirname(p)
+            if p.startswith("config/examples/"):
+                p = p[len("config/examples/"):]
+            paths.add(p)
+    return sorted(paths)
+
+# the search index of a list of paths: the squashed paths and trigram -> ids of the paths containing it
+def buildExampleIndex(b,paths):
+    postings = {}
+    squashed = []
+    for i, p in enumerate(paths):
+        sp = squash(p)
+        squashed.append(sp)
+        for g in sorted(trigrams(sp)):
+            postings.setdefault(g, []).append(i)
+    return {"branch": b, "paths": paths, "squashed": squashed, "postings": postings}
+
+# a cached index, None if it is missing or unreadable
+def readExampleIndex(b,indexfile):
+    try:
+        with open(indexfile, encoding="utf8") as r:
+            index = json.load(r)
+        if "postings" not in index:
+            index = buildExampleIndex(b, index['paths'])	# written by an older version
+        return index
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug("unable to read " + indexfile + ": " + str(e))
+        return None
+
+# load (or build) the cached example index for a branch
+def getExampleIndex(b,refresh=False,maxwait=None):
+    logger.debug("getExampleIndex()")
+    indexfile = os.path.join(cachedir if storeEnabled() else ".", "index", re.sub("[^A-Za-z0-9._-]", "_", b) + ".json")
+    if not refresh and isFile(indexfile):
+        if time.time() - os.path.getmtime(indexfile) < indexmaxage * 3600:
+            index = readExampleIndex(b, indexfile)
+            if index is not None:
+                return index
+    paths = getExampleTree(b, maxwait)
+    if paths is None:
+        # fall back to a stale index if github is not reachable
+        index = readExampleIndex(b, indexfile) if isFile(indexfile) else None
+        if index is None:
+            return buildExampleIndex(b, [])
+        Message_Warning("Using the cached example list of " + str(b) + ", it may be out of date.")
+        return index
+    index = buildExampleIndex(b, paths)
+    if storeEnabled():
+        os.makedirs(os.path.dirname(indexfile), exist_ok=True)
+        atomicWrite(indexfile, json.dumps(index, separators=(",", ":")).encode("utf8"))
+    return index
+
+# rank the example paths of an index against a query, best first. returns [(score, path)]
+def searchExamples(index,text,limit=10):
+    words = [squash(w) for w in str(text).split()]
+    words = [w for w in words if w]
+    if not words:
+        return []
+    paths = index['paths']
+    squashed = index['squashed']
+    postings = index['postings']
+
+    # score = share of the query trigrams found, short words must match as a substring
+    qgrams = set()
+    for w in words:
+        qgrams |= trigrams(w)
+    hits = {}
+    for g in qgrams:
+        for i in postings.get(g, []):
+            hits[i] = hits.get(i, 0) + 1
+    shortwords = [w for w in words if len(w) < 3]
+    candidates = hits.keys() if qgrams else range(len(paths))
+    results = []
+    for i in candidates:
+        score = hits.get(i, 0) / len(qgrams) if qgrams else 0.0
+        for w in words:
+            if w in squashed[i]:
+                score += 1.0 / len(words)
+        if shortwords and not all(w in squashed[i] for w in shortwords):
+            score /= 2
+        results.append((round(score, 4), paths[i]))
+    results.sort(key=lambda x: (-x[0], len(x[1]), x[1]))
+    return results[:limit]
+
+# suggest the closest example paths when the configured one does not exist
+def suggestExamplePaths():
+    results = searchExamples(getExampleIndex(branch, maxwait=errDelay), " ".join(path.replace("/", " ").split()), 5)
+    if results:
+        Message_Warning("   Closest examples in " + branch + ":")
+        for score, p in results:
+            Message_Warning("      " + p)
+
+# --opmode search
+def runSearch():
+    logger.debug("runSearch()")
+    if query == 'None':
+        ExitStageLeft(400,"--opmode search needs --query")
+    start = time.monotonic()
+    index = getExampleIndex(branch)
+    results = searchExamples(index, query)
+    Message_Header("Examples in " + branch + " matching '" + query + "' (" + str(len(index['paths'])) + " indexed, " + str(round((time.monotonic() - start) * 1000, 1)) + " ms)")
+    if not results:
+        Message_Warning("   No matching examples found.")
+    for score, p in results:
+        Message_Config("   " + p)
+
+#####################################################
+##### FUNCTIONS - MARLIN SOURCE INDEX
+#####################################################
+# the set of directive names the target's Marlin/src actually tests or defines
+# (#if/#ifdef/#elif, ENABLED() & friends, PIN_EXISTS(), #define/#undef). it is
+# used by --missing auto to tell a valid directive missing from the example
+# apart from a typo. the source files are scanned in parallel as memory mapped
+# bytes and the result is cached per source tree signature.
+
+universeversion = 1					# bump when the scanner changes to invalidate cached sets
+source_ext = ('.h', '.cpp', '.c', '.hpp', '.ino')
+cond_re = re.compile(rb"^[ \t]*#[ \t]*(?:if|ifdef|ifndef|elif)\b((?:\\\r?\n|[^\n])*)", re.M)
+define_re = re.compile(rb"^[ \t]*#[ \t]*(?:define|undef)[ \t]+([A-Za-z_]\w*)", re.M)
+macro_re = re.compile(rb"\b(ENABLED|DISABLED|ANY|ALL|BOTH|EITHER|NONE|TERN_?|TERN0|TERN1|IF_ENABLED|IF_DISABLED|OPTITEM|PIN_EXISTS)\s*\(((?:[^()]|\([^()]*\))*)\)")
+comment_re = re.compile(rb"//.*|/\*.*?\*/")
+ident_re = re.compile(rb"[A-Za-z_]\w*")
+
+# scan a list of source files, returns the set of names (bytes)
+def scanSourceFiles(sources):
+    names = set()
+    for f in sources:
+        try:
+            with open(f, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for match in cond_re.finditer(m):
+                        names.update(ident_re.findall(comment_re.sub(b"", match.group(1))))
+                    names.update(define_re.findall(m))
+                    for match in macro_re.finditer(m):
+                        args = ident_re.findall(match.group(2))
+                        if match.group(1) == b"PIN_EXISTS":
+                            args = [a + b"_PIN" for a in args]
+                        names.update(args)
+        except (OSError, ValueError) as e:
+            logger.debug("scanSourceFiles skipped " + str(f) + ": " + str(e))
+    names.discard(b"defined")
+    return names
+
+# load (or build) the directive universe of the target Marlin tree, None if there is no source
+def getDirectiveUniverse():
+    logger.debug("getDirectiveUniverse()")
+    global universe
+    if universe is not None:
+        return universe
+    src = os.path.join(targetdir, "Marlin", "src")
+    if not isDir(src):
+        return None
+    start = time.monotonic()
+
+    # signature of the tree: every source file with its size and mtime
+    sources = []
+    sig = hashlib.sha256(str(universeversion).encode("utf8"))
+    for root, dirs, names in os.walk(src):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(source_ext):
+                f = os.path.join(root, name)
+                st = os.stat(f)
+                sources.append(f)
+                sig.update((os.path.relpath(f, src) + "|" + str(st.st_size) + "|" + str(st.st_mtime_ns) + "\n").encode("utf8"))
+    cachefile = os.path.join(cachedir, "universe", sig.hexdigest() + ".json")
+    if storeEnabled() and isFile(cachefile):
+        try:
+            with open(cachefile, encoding="utf8") as r:
+                universe = set(json.load(r))
+            Message_Debug("   Loaded " + str(len(universe)) + " Marlin directives from " + cachefile)
+            return universe
+        except (OSError, ValueError):
+            pass
+
+    # scan in parallel, a few chunks per cpu to even out the file sizes
+    workers = os.cpu_count() or 1
+    chunks = [sources[i::workers * 4] for i in range(workers * 4)]
+    found = set()
+    if workers > 1 and len(sources) > 50:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for names in pool.map(scanSourceFiles, chunks):
+                found |= names
+    else:
+        found = scanSourceFiles(sources)
+    universe = set(n.decode("ascii", "replace") for n in found)
+    Message_Config("   Indexed " + str(len(universe)) + " directives used by " + str(len(sources)) + " Marlin source files in " + str(round((time.monotonic() - start) * 1000)) + " ms")
+    if storeEnabled():
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        atomicWrite(cachefile, json.dumps(sorted(universe)).encode("utf8"))
+    return universe
+
 #####################################################
 ##### FUNCTIONS - CONFIGURATON FILE DIRECTIVES
 #####################################################
@@ -681,9 +1862,73 @@ def getDirective(directive,test_str):
 
     return results
 
-# inject marlin-configurator.py header into every file in the list
-def injectMetaHeader():
-    logger.debug("injectMetaData())")
+# one #define line, enabled or commented out: indent, //, name, value, comment
+# (a // inside a quoted value is not treated as the start of a comment)
+directive_re = re.compile(r"^(\s*)(//)?\s*#define\s+([A-Za-z_]\w*)(?:\s+((?:\"(?:[^\"\\]|\\.)*\"|'[^']*'|[^\"'/]|/(?!/))*?))?(\s*//.*)?$")
+
+# parse all directives in a file into name -> [(line, enabled, value, comment), ...]
+def parseDirectives(text):
+    directives = {}
+    for lineno, line in enumerate(text.splitlines()):
+        if "#define" not in line:
+            continue
+        m = directive_re.match(line)
+        if m:
+            directives.setdefault(m.group(3), []).append((lineno, m.group(2) is None, (m.group(4) or "").strip(), m.group(5) or ""))
+    return directives
+
+parseversion = 1					# bump when directive_re or the parsed layout changes to invalidate cache/parsed
+
+# parseDirectives() through a cache keyed by the hash of the text, which for a
+# stock example file is its hash in the store, so every target and worker using
+# the example shares the entry (and storeFlush() drops it with the blob). the
+# result is kept with marshal, which loads several times faster than the file can
+# be lexed. offset shifts the line numbers, for a text that follows a header.
+def getParsedDirectives(text,offset=0):
+    if not storeEnabled():
+        return shiftDirectives(parseDirectives(text),offset)
+    h = hashData(text.encode("utf8"))
+    cachefile = os.path.join(cachedir, "parsed", h[:2], h)
+    stamp = (parseversion, marshal.version, directive_re.pattern)
+    try:
+        with open(cachefile, "rb") as r:
+            cached = marshal.loads(r.read())
+        if cached[0] == stamp:
+            return shiftDirectives(cached[1],offset)
+    except (OSError, ValueError, EOFError, TypeError, IndexError):
+        pass
+    directives = parseDirectives(text)
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        atomicWrite(cachefile, marshal.dumps((stamp, directives)))
+    except OSError as e:
+        logger.warning("Could not cache parsed directives in " + cachefile + ": " + str(e))
+    return shiftDirectives(directives,offset)
+
+def shiftDirectives(directives,offset):
+    if offset == 0:
+        return directives
+    return dict((name, [(lineno + offset, enabled, value, comment) for lineno, enabled, value, comment in entries]) for name, entries in directives.items())
+
+# split the text of a configuration file into our meta header and the example text after it
+def splitMetaHeader(text):
+    if text.startswith("/**\n * marlin-configurator.py v"):
+        end = text.find(" */\n\n")
+        if end >= 0:
+            return text[:end + 5], text[end + 5:]
+    return "", text
+
+# reduce parsed directives to name -> (enabled, value) using the first enabled
+# occurrence (or the first one if they are all disabled)
+def directiveStates(directives):
+    states = {}
+    for name, entries in directives.items():
+        entry = next((e for e in entries if e[1]), entries[0])
+        states[name] = (entry[1], entry[2])
+    return states
+
+# the marlin-configurator.py header for the configuration files we change
+def getMetaHeader():
     # globals where the settings are stored
     global version
     global repourl
@@ -731,21 +1976,27 @@ def injectMetaHeader():
     metaheader += " */\n\n"
     
     logger.info(metaheader) # may as well put this info in the log :-)
+    return metaheader
 
-    # open each file in the files array and attemptm to inject the header at the top
+# inject marlin-configurator.py header into the configuration files we change.
+# the other files (_Bootscreen.h etc) are left identical to the example so they
+# can be shared from the store.
+def injectMetaHeader():
+    logger.debug("injectMetaData())")
+    global files
+    global targetdir
+    metaheader = getMetaHeader()
+
+    # open each configuration file in the files array and attempt to inject the header at the top
     # silently fails if the file is not valid
     try:
         for fl in files:
             file = targetdir + "/Marlin/" + fl
+            if fl not in ['Configuration.h','Configuration_adv.h']:
+                continue
             Message_Config("   Injecting Meta Header into " + file)
-            if isFile(file):
-                fh = open(file, "r",encoding="utf8")
-                data = fh.read()
-                fh.close()
-                data = metaheader + data
-                fh = open(file, "w",encoding="utf8")
-                fh.write(data)
-                fh.close()
+            if isFileStaged(file):
+                writeFile(file,metaheader + readFile(file))
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in injectMetaData",ioe)
         print(ioe)
@@ -759,11 +2010,10 @@ def addDirective(directive,file):
     Message_Config('   Adding Directive ' + directive + ' to ' + file)
     global version
     
-    # open the files in append mode, save the change, and close
+    # append to the staged content of the file
     try:
-        f = open(file, "a",encoding="utf8")
-        f.write("\n#define " + directive + "  // added by marlin-configurator v" + version)
-        f.close()
+        metricInc("directives_total", 1, {"action": "added"})
+        writeFile(file,readFile(file) + "\n#define " + directive + "  // added by marlin-configurator v" + version)
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in addDirective",ioe)
         print(ioe)
@@ -771,6 +2021,262 @@ def addDirective(directive,file):
         Message_Exception("Exception Occured in addDirective",e)
         print(e)
 
+# the line we append for a missing directive
+def missingLine(directive,value):
+    if value is None:
+        return "\n" + "#define " + directive + "  // added by marlin-configurator v" + version
+    return "\n" + "#define " + directive + " " + value + "  // added by marlin-configurator v" + version
+
+# decide what to do with a directive that is in neither file. value is None
+# when enabling. added lines are appended to the documents of both files.
+def missingDirective(directive,value,doc1,doc2):
+    note = historyNote(directive)
+    if note:
+        Message_Warning("      " + note)
+    candidates = suggestDirectives(directive,doc1,doc2)
+    best = bestSuggestion(candidates)
+    if candidates:
+        Message_Warning("      " + directive + " not found. Did you mean " + ", ".join(name for d, name in candidates[:3]) + " ?")
+    if missing == "fix":
+        # batch auto-fix: use the single closest name, otherwise skip
+        if best is not None:
+            fixDirective(directive,value,best,doc1,doc2)
+        else:
+            Message_Warning("      " + directive + " not found and no single directive within " + str(distance) + " edits. Skipping.")
+        return
+    if missing == "auto":
+        # add it only if marlin actually uses it, otherwise it is most likely a typo
+        known = getDirectiveUniverse()
+        if known is None:
+            Message_Warning("      " + directive + " not found. Missing is set to 'auto' but the Marlin source is not available. Skipping.")
+        elif directive in known:
+            Message_Warning("      " + directive + " not found. Marlin uses it. Adding to Configuration.h.")
+            metricInc("directives_total", 1, {"action": "added"})
+            doc1["added"].append((directive, missingLine(directive,value)))
+        else:
+            Message_Warning("      " + directive + " not found and Marlin does not use it (typo?). Skipping.")
+        return
+    if mode == "interactive":
+        # interactive mode, the suggestions above already said it is not found
+        if not candidates:
+            Message_Warning("      " + directive + " not found.")
+        if best is not None:
+            oktogo = multi_choice_question(['abort','skip','add','fix'],'Abort, Skip, Add, or Fix (use ' + best + ') ? ','Missing Directive')
+        else:
+            oktogo = multi_choice_question(['abort','skip','add'],'Abort, Skip, or Add ? ','Missing Directive')    
+        if oktogo == "abort":
+            ExitStageLeft(404,"Missing Configuration File. User Cancelled.")
+        if oktogo == "fix":
+            fixDirective(directive,value,best,doc1,doc2)
+        if oktogo == "add":
+            metricInc("directives_total", 1, {"action": "added"})
+            file = multi_choice_question(['Configuration.h','Configuration_adv.h'],'Which file to add it to ? ','Add Missing Directive')
+            if file == "Configuration.h":
+                doc1["added"].append((directive, missingLine(directive,value)))
+            if file == "Configuration_adv.h":
+                doc2["added"].append((directive, missingLine(directive,value)))
+        if oktogo == "skip":
+            Message_Warning("      " + directive + " not found. User Skipped.")
+    else:
+        # batch mode
+        if missing == "skip":
+            Message_Warning("      " + directive + " not found. Batch Mode. Missing is set to 'skip'. Skipping.")
+        else:
+            Message_Warning("      " + directive + " not found. Batch Mode. Missing it set to 'add'. Adding to both files.")
+            metricInc("directives_total", 1, {"action": "added"})
+            doc1["added"].append((directive, missingLine(directive,value)))
+            doc2["added"].append((directive, missingLine(directive,value)))
+
+#####################################################
+##### FUNCTIONS - DIRECTIVE SUGGESTIONS
+#####################################################
+# a missing directive is usually a typo or a renamed option. the names of the
+# loaded headers go into a BK-tree, a metric tree that only visits the branches
+# whose edit distance can still be within the limit, and the distance itself
+# uses the bit-parallel algorithm of Myers/Hyyro, so a lookup over a few
+# thousand names takes well under a millisecond.
+
+distance = 2						# max edits for a suggestion, and for --missing fix
+fixes = {}							# missing directive -> directive it was fixed to
+suggesttree = None					# (key of the headers, tree), see suggestDirectives()
+
+# bit masks of the positions of each character of a, for editDistance()
+def editPattern(a):
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+# levenshtein distance of a and b (pass peq when comparing a with many names)
+def editDistance(a,b,peq=None):
+    m = len(a)
+    if m == 0:
+        return len(b)
+    if peq is None:
+        peq = editPattern(a)
+    full = (1 << m) - 1
+    top = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & top:
+            score += 1
+        elif mh & top:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+    return score
+
+# a BK-tree node is [name, {distance: child}]
+def bkInsert(tree,name):
+    if tree is None:
+        return [name, {}]
+    peq = editPattern(name)
+    node = tree
+    while True:
+        d = editDistance(name, node[0], peq)
+        if d == 0:
+            return tree
+        if d not in node[1]:
+            node[1][d] = [name, {}]
+            return tree
+        node = node[1][d]
+
+# [(distance, name)] within limit of name, closest first
+def bkSearch(tree,name,limit):
+    found = []
+    if tree is None:
+        return found
+    peq = editPattern(name)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        d = editDistance(name, node[0], peq)
+        if d <= limit:
+            found.append((d, node[0]))
+        for k, child in node[1].items():
+            if d - limit <= k <= d + limit:
+                stack.append(child)
+    return sorted(found)
+
+# close directive names of the loaded headers, [(distance, name)] (case is ignored)
+def suggestDirectives(directive,doc1,doc2,limit=None):
+    global suggesttree
+    parsed = [doc.get("parsed", {}) for doc in (doc1, doc2)]
+    key = tuple(id(p) for p in parsed)
+    if suggesttree is None or suggesttree[0] != key:
+        tree = None
+        names = {}
+        for p in parsed:
+            for name in p:
+                names[name.upper()] = name
+        for upper in sorted(names):
+            tree = bkInsert(tree, upper)
+        suggesttree = (key, tree, names)
+    limit = distance if limit is None else limit
+    return [(d, suggesttree[2][n]) for d, n in bkSearch(suggesttree[1], directive.upper(), limit) if d > 0 or n != directive]
+
+# the one closest suggestion, None if there is none or it is a tie
+def bestSuggestion(candidates):
+    if not candidates or (len(candidates) > 1 and candidates[1][0] == candidates[0][0]):
+        return None
+    return candidates[0][1]
+
+# apply the option of a missing directive to the suggested one instead
+def fixDirective(directive,value,target,doc1,doc2):
+    Message_Warning("      " + directive + " fixed to " + target + ".")
+    metricInc("directives_total", 1, {"action": "fixed"})
+    fixes[directive] = target
+    applyOption(target, "enable" if value is None else "value", value, doc1, doc2)
+
+#####################################################
+##### FUNCTIONS - DIRECTIVE DOCUMENTS
+#####################################################
+# the configuration files are edited as lists of lines. every directive line is
+# indexed once when the file is loaded, so applying (or reverting) an option only
+# touches the lines of that directive and never rescans the whole file. the
+# stock lines are kept so --watch can put a directive back before re-applying it.
+
+documents = {}						# file -> document, see getDocument()
+
+# a document of a file's text
+def textDocument(text):
+    lines = text.splitlines(True)
+    header, body = splitMetaHeader(text)
+    return {"source": lines, "lines": list(lines), "parsed": getParsedDirectives(body, len(header.splitlines(True))), "added": []}
+
+# load a staged file into a document
+def loadDocument(f):
+    return textDocument(readFile(f))
+
+# the document of a file, loaded on first use
+def getDocument(f):
+    global documents
+    if f not in documents:
+        documents[f] = loadDocument(f)
+    return documents[f]
+
+# the current text of a document
+def renderDocument(doc):
+    return "".join(doc["lines"]) + "".join(line for name, line in doc["added"])
+
+# stage the current text of a document
+def saveDocument(f):
+    writeFile(f,renderDocument(documents[f]))
+
+# rewrite a single directive line. kind is enable, disable or value
+def rewriteLine(line,kind,value=None):
+    body = line.rstrip("\r\n")
+    m = directive_re.match(body)
+    if m is None:
+        return line
+    indent = m.group(1)
+    if kind == "disable":
+        if m.group(2) is not None:
+            return line
+        return indent + "//" + line[len(indent):]
+    if kind == "enable":
+        if m.group(2) is None:
+            return line
+        return indent + line[m.end(2):].lstrip(" \t")
+    return indent + "#define " + m.group(3) + " " + value + (m.group(5) or "") + line[len(body):]
+
+# apply an action to every line of a directive, false if the file does not have it
+def applyDirective(doc,directive,kind,value=None):
+    found = doc["parsed"].get(directive)
+    if not found:
+        return False
+    for lineno, enabled, old, comment in found:
+        doc["lines"][lineno] = rewriteLine(doc["lines"][lineno],kind,value)
+    return True
+
+# put the lines of a directive back to stock and drop any line we added for it
+def revertDirective(doc,directive):
+    for lineno, enabled, old, comment in doc["parsed"].get(directive, []):
+        doc["lines"][lineno] = doc["source"][lineno]
+    doc["added"] = [a for a in doc["added"] if a[0] != directive]
+
+# apply an action to both configuration files, true if either has the directive
+def applyOption(directive,kind,value,doc1,doc2):
+    exists = False
+    for doc, name in [(doc1, "Configuration.h"), (doc2, "Configuration_adv.h")]:
+        if applyDirective(doc,directive,kind,value):
+            exists = True
+            msg = "      " + directive + (" = " + value if kind == "value" else "") + " (" + name + ")"
+            if silent == True:
+                logger.info(msg)
+            else:
+                Message_Config(msg)
+    return exists
+
 # enable a directive
 def enableDirectives():
     logger.debug("enableDirectives()")
@@ -778,77 +2284,22 @@ def enableDirectives():
     global options_enable
     global f_config
     global f_config_adv
-    global mode
-    global version
-    exists = False
-    oktogo = "abort"
-    file = "Configuration.h"
 
     try:
-        # open the two config files, read them, and close them
-        f1 = open(f_config, "rt",encoding="utf8")
-        f2 = open(f_config_adv, "rt",encoding="utf8")
-        data1 = f1.read()
-        data2 = f2.read()
-        f1.close()
-        f2.close()
+        doc1 = getDocument(f_config)
+        doc2 = getDocument(f_config_adv)
 
         # enable all matching directives
         for key in options_enable:
             directive = str(key)
-            disabled = "//#define " + directive
-            enabled = "#define " + directive
-            pattern = "^(\s*)(\/\/)(\s*)#define(\s*)" + directive + "(\s)"
-            if findDirective(directive,data1):
-                exists = True
-                msg = "      " + directive + " (Configuration.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)
-                data1 = data1.replace(disabled, enabled)
-                #data1 = re.sub(pattern, enabled, data1, re.MULTILINE)
-            if findDirective(directive,data2):
-                exists = True
-                msg = "      " + directive + " (Configuration_adv.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)
-                data2 = data2.replace(disabled, enabled)
-                #data2 = re.sub(pattern, enabled, data2, re.MULTILINE)
+            exists = applyOption(directive,"enable",None,doc1,doc2)
+            metricInc("directives_total", 1, {"action": "enabled" if exists else "missing"})
             if exists == False:
-                if mode == "interactive":
-                    # interactive mode
-                    Message_Warning("      " + directive + " not found.")
-                    oktogo = multi_choice_question(['abort','skip','add'],'Abort, Skip, or Add ? ','Missing Directive')    
-                    if oktogo == "abort":
-                        ExitStageLeft(404,"Missing Configuration File. User Cancelled.")
-                    if oktogo == "add":
-                        file = multi_choice_question(['Configuration.h','Configuration_adv.h'],'Which file to add it to ? ','Add Missing Directive')
-                        if file == "Configuration.h":
-                            data1 += "\n" + "#define " + directive + "  // added by marlin-configurator v" + version
-                        if file == "Configuration_adv.h":
-                            data2 += "\n" + "#define " + directive + "  // added by marlin-configurator v" + version
-                    if oktogo == "skip":
-                        Message_Warning("      " + directive + " not found. User Skipped.")
-                else:
-                    # batch mode
-                    if missing == "skip":
-                        Message_Warning("      " + directive + " not found. Batch Mode. Missing is set to 'skip'. Skipping.")
-                    else:
-                        Message_Warning("      " + directive + " not found. Batch Mode. Missing it set to 'add'. Adding to both files.")
-                        data1 += "\n" + "#define " + directive + "  // added by marlin-configurator v" + version
-                        data2 += "\n" + "#define " + directive + "  // added by marlin-configurator v" + version
-            exists = False
+                missingDirective(directive,None,doc1,doc2)
 
-        # reopen the files in write mode, save the changes, and close them
-        f1 = open(f_config, "wt",encoding="utf8")
-        f2 = open(f_config_adv, "wt",encoding="utf8")
-        f1.write(data1)
-        f2.write(data2)
-        f1.close()
-        f2.close()
+        # stage the changes, they are written out by commitWrites()
+        saveDocument(f_config)
+        saveDocument(f_config_adv)
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in enableDirectives",ioe)
         print(ioe)
@@ -863,49 +2314,22 @@ def disableDirectives():
     global options_disable
     global f_config
     global f_config_adv
-    exists = False
 
     try:
-        # open the two config files, read them, and close them
-        f1 = open(f_config, "rt",encoding="utf8")
-        f2 = open(f_config_adv, "rt",encoding="utf8")
-        data1 = f1.read()
-        data2 = f2.read()
-        f1.close()
-        f2.close()
+        doc1 = getDocument(f_config)
+        doc2 = getDocument(f_config_adv)
 
-        # enable all matching directives
+        # disable all matching directives
         for key in options_disable:
             directive = str(key)
-            disabled = "//#define " + directive
-            enabled = "#define " + directive
-            if findDirective(directive,data1):
-                exists = True
-                msg = "      " + directive + " (Configuration.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)
-                data1 = data1.replace(enabled,disabled)
-            if findDirective(directive,data2):
-                exists = True
-                msg = "      " + directive + " (Configuration_adv.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)                
-                data2 = data2.replace(enabled,disabled)
+            exists = applyOption(directive,"disable",None,doc1,doc2)
+            metricInc("directives_total", 1, {"action": "disabled" if exists else "missing"})
             if exists == False:
                 Message_Warning("      " + directive + " not found. Effectively the same as disabled. Skipping.")
-            exists = False
 
-        # reopen the files in write mode, save the changes, and close them
-        f1 = open(f_config, "wt",encoding="utf8")
-        f2 = open(f_config_adv, "wt",encoding="utf8")
-        f1.write(data1)
-        f2.write(data2)
-        f1.close()
-        f2.close()
+        # stage the changes, they are written out by commitWrites()
+        saveDocument(f_config)
+        saveDocument(f_config_adv)
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in disableDirectives",ioe)
         print(ioe)
@@ -915,97 +2339,28 @@ def disableDirectives():
 
 # enable (if disabled) and then change value
 def updateValues():
-    logger.debug("enableDirectives()")
+    logger.debug("updateValues()")
     Message_Config("   Updating Values")
     global options_values
     global f_config
     global f_config_adv
-    global mode
-    global version
-    exists = False
-    oktogo = "abort"
-    file = "Configuration.h"
 
     try:
-        # open the two config files, read them, and close them
-        f1 = open(f_config, "rt",encoding="utf8")
-        f2 = open(f_config_adv, "rt",encoding="utf8")
-        data1 = f1.read()
-        data2 = f2.read()
-        f1.close()
-        f2.close()
-        reg_pre = "^(\s*?)(#define "
-        reg_post = "\s+)(.*?)(\s*\/\/.*)?$"
+        doc1 = getDocument(f_config)
+        doc2 = getDocument(f_config_adv)
 
-        # enable all matching directives
+        # set the value of all matching directives (this also enables them)
         for key in options_values:
             directive = str(key)
             value = str(options_values[key])
-            pattern = reg_pre + directive + reg_post
-            subst = str("#define " + directive + " " + value)
-            disabled = "//#define " + directive
-            enabled = "#define " + directive
-
-            if findDirective(directive,data1):
-                exists = True
-                msg = "      " + directive + " = " + value + " (Configuration.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)
-                spaces = str(getDirective(directive,data1)[0])
-                comment = str(getDirective(directive,data1)[3])
-                if comment != "None":
-                    subst = spaces + subst + " " + comment
-                data1 = data1.replace(disabled, enabled)
-                data1 = re.sub(pattern,subst,data1,0,re.MULTILINE)
-            
-            if findDirective(directive,data2):
-                exists = True
-                msg = "      " + directive + " = " + value + " (Configuration_adv.h)"
-                if silent == True:
-                    logger.info(msg)
-                else:
-                    Message_Config(msg)
-                spaces = str(getDirective(directive,data2)[0])
-                comment = str(getDirective(directive,data2)[3])
-                if comment != "None":
-                    subst = spaces + subst + " " + comment
-                data2 = data2.replace(disabled, enabled)
-                data2 = re.sub(pattern,subst,data2,0,re.MULTILINE)
-            
-            if exists == False:   
-                if mode == "interactive":
-                    # interactive mode
-                    Message_Warning("      " + directive + " not found.")
-                    oktogo = multi_choice_question(['abort','skip','add'],'Abort, Skip, or Add ? ','Missing Directive')    
-                    if oktogo == "abort":
-                        ExitStageLeft(404,"Missing Configuration File. User Cancelled.")
-                    if oktogo == "add":
-                        file = multi_choice_question(['Configuration.h','Configuration_adv.h'],'Which file to add it to ? ','Add Missing Directive')
-                        if file == "Configuration.h":
-                            data1 += "\n" + "#define " + directive + " " + value + "  // added by marlin-configurator v" + version
-                        if file == "Configuration_adv.h":
-                            data2 += "\n" + "#define " + directive + " " + value + "  // added by marlin-configurator v" + version
-                    if oktogo == "skip":
-                        Message_Warning("      " + directive + " not found. User Skipped.")
-                else:
-                    # batch mode
-                    if missing == "skip":
-                        Message_Warning("      " + directive + " not found. Batch Mode. Missing is set to 'skip'. Skipping.")
-                    else:
-                        Message_Warning("      " + directive + " not found. Batch Mode. Missing it set to 'add'. Adding to both files.")
-                        data1 += "\n" + "#define " + directive + " " + value + "  // added by marlin-configurator v" + version
-                        data2 += "\n" + "#define " + directive + " " + value + "  // added by marlin-configurator v" + version
-            exists = False
+            exists = applyOption(directive,"value",value,doc1,doc2)
+            metricInc("directives_total", 1, {"action": "updated" if exists else "missing"})
+            if exists == False:
+                missingDirective(directive,value,doc1,doc2)
 
-        # reopen the files in write mode, save the changes, and close them
-        f1 = open(f_config, "wt",encoding="utf8")
-        f2 = open(f_config_adv, "wt",encoding="utf8")
-        f1.write(data1)
-        f2.write(data2)
-        f1.close()
-        f2.close()
+        # stage the changes, they are written out by commitWrites()
+        saveDocument(f_config)
+        saveDocument(f_config_adv)
     except IOError as ioe: ##error message
         Message_Exception("IOError Occured in updateValues",ioe)
         print(ioe)
@@ -1013,6 +2368,1754 @@ def updateValues():
         Message_Exception("Exception Occured in updateValues",e)
         print(e)
 
+#####################################################
+##### FUNCTIONS - OUTPUT ARCHIVE
+#####################################################
+# --output-archive writes the staged files straight into a tar, tar.gz or zip
+# (or a tar on stdout) instead of the target directory, one entry per file as
+# <config>/<path in targetdir>. entries are sorted and carry fixed times, owners
+# and modes, so the same configuration always gives a byte-identical archive.
+
+# (entry name, bytes) of every staged file, sorted
+def archiveEntries():
+    prefix = os.path.splitext(os.path.basename(JSONFile))[0]
+    entries = []
+    for f in sorted(pendingWrites):
+        rel = os.path.relpath(f, targetdir)
+        if rel.startswith(".."):
+            rel = os.path.basename(f)
+        entries.append((prefix + "/" + rel.replace(os.sep, "/"), pendingWrites[f].encode("utf8")))
+    return sorted(entries)
+
+def writeTar(fh,entries,mode="w"):
+    with tarfile.open(fileobj=fh, mode=mode, format=tarfile.PAX_FORMAT) as tar:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 0
+            info.mode = 0o644
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            tar.addfile(info, io.BytesIO(data))
+
+def writeZip(fh,entries):
+    with zipfile.ZipFile(fh, "w") as zf:
+        for name, data in entries:
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            zf.writestr(info, data)
+
+# write the staged files into the archive, the format follows the extension
+def writeArchive(dest):
+    logger.debug("writeArchive()")
+    entries = archiveEntries()
+    if dest == "-":
+        writeTar(sys.__stdout__.buffer, entries, "w|")
+        sys.__stdout__.buffer.flush()
+        Message_Config("   Wrote " + str(len(entries)) + " files to stdout (tar)")
+        return
+    tmp = dest + ".tmp-" + str(os.getpid())
+    try:
+        if os.path.dirname(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(tmp, "wb") as fh:
+            if dest.endswith(".zip"):
+                writeZip(fh, entries)
+            elif dest.endswith(".tar.gz") or dest.endswith(".tgz"):
+                with gzip.GzipFile(filename="", mode="wb", fileobj=fh, mtime=0) as gz:
+                    writeTar(gz, entries)
+            elif dest.endswith(".tar"):
+                writeTar(fh, entries)
+            else:
+                ExitStageLeft(400,"--output-archive must end in .tar, .tar.gz, .tgz or .zip (or be - for stdout): " + dest)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    Message_Config("   Wrote " + str(len(entries)) + " files to " + dest)
+
+#####################################################
+##### FUNCTIONS - STREAMING REWRITER
+#####################################################
+# --stream True, for small hosts (octoprint on a pi). the example files are
+# downloaded in chunks straight into the store, then Configuration.h and
+# Configuration_adv.h go through a generator pipeline one line at a time:
+# source -> meta header -> directive actions -> temp file, and the temp file
+# only replaces the target when it differs. nothing holds a whole header, only
+# the directive names are kept for suggestions, so memory stays flat however
+# large the files are.
+
+# download an example file in chunks into the store (or a temp file next to f when
+# there is no store) and note where streamConfigFiles() reads it from. returns its hash
+def streamDownload(url,f):
+    HEADERS = {'Accept-Language': 'en-US,en;q=0.5', 'Cache-Control': 'no-cache', 'User-Agent': 'Marlin Configurator v' + version}
+    ref = storeRef(url)
+    if ref.get('etag') and storeHas(ref.get('hash', "")):
+        HEADERS['If-None-Match'] = ref['etag']
+    tmp = f + ".src-" + str(os.getpid())
+    for rt in range(1,retries+1):
+        try:
+            r = fetch(url, HEADERS, stream=True)
+            with r:
+                if r.status_code == 304:
+                    metricInc("cache_hits_total")
+                    Message_Debug("     " + url + " not modified, using the store")
+                    storeTouch(ref['hash'])
+                    streamed[f] = (storePath(ref['hash']), False)
+                    return ref['hash']
+                if r.status_code == 404:
+                    Message_Warning("   Configuration Example File Not Found at " + url)
+                    suggestExamplePaths()
+                    ExitStageLeft(404,"Configuration Example File Not Found at " + url)
+                r.raise_for_status()
+                if r.status_code != 200:
+                    raise Exception("response code " + str(r.status_code))	# only a whole file is stored and pinned
+                sha = hashlib.sha256()
+                size = 0
+                os.makedirs(os.path.dirname(os.path.abspath(tmp)), exist_ok=True)
+                with open(tmp, "wb") as w:
+                    for chunk in r.iter_content(65536):
+                        sha.update(chunk)
+                        w.write(chunk)
+                        size += len(chunk)
+                    w.flush()
+                    os.fsync(w.fileno())
+            h = sha.hexdigest()
+            metricInc("files_fetched_total")
+            metricInc("fetched_bytes_total", size)
+            if storeEnabled():
+                storePutFile(tmp, h)
+                storeSetRef(url, {"hash": h, "etag": r.headers.get('ETag', "")})
+                streamed[f] = (storePath(h), False)
+            else:
+                streamed[f] = (tmp, True)
+            return h
+        except Exception as e: ##error message
+            logger.warning("attempt " + str(rt) + " of " + str(retries) + " for " + url + " failed: " + str(e))
+            logger.exception(e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            metricInc("fetch_retries_total")
+            if rt < retries:
+                time.sleep(errDelay)
+    ExitStageLeft(500,"All request attempts for " + str(url) + " failed. Please try again.")
+
+# the lines of a downloaded example file, read from the store (or its temp file)
+def streamSource(f):
+    src, temp = streamed.pop(f)
+    try:
+        with open(src, "rt", encoding="utf8", newline="") as r:
+            yield from r
+    finally:
+        if temp and os.path.exists(src):
+            os.remove(src)
+
+# the lines of a file, removing it after the last one
+def streamTemp(f):
+    try:
+        with open(f, "rt", encoding="utf8", newline="") as r:
+            yield from r
+    finally:
+        os.remove(f)
+
+def streamHeader(lines,header):
+    yield from header.splitlines(True)
+    yield from lines
+
+# apply the actions of each directive to its lines, noting the directives seen
+def streamRewrite(lines,actions,found):
+    for line in lines:
+        if "#define" in line:
+            m = directive_re.match(line.rstrip("\r\n"))
+            if m and m.group(3) in actions:
+                found.add(m.group(3))
+                for kind, value in actions[m.group(3)]:
+                    line = rewriteLine(line,kind,value)
+        yield line
+
+# the directive names of a file as name -> [] (like parsed directives), for the suggestions
+def streamNames(f):
+    names = {}
+    with open(f, "rt", encoding="utf8", newline="") as r:
+        for line in r:
+            if "#define" in line:
+                m = directive_re.match(line.rstrip("\r\n"))
+                if m:
+                    names.setdefault(m.group(3), [])
+    return names
+
+# write lines to a temp file next to f, returns its name
+def streamWrite(f,lines,suffix=".tmp-"):
+    tmp = f + suffix + str(os.getpid())
+    with open(tmp, "wt", encoding="utf8") as w:
+        for line in lines:
+            w.write(line)
+    return tmp
+
+# swap the temp file into place if it differs from f, true if f changed
+def streamFinish(tmp,f):
+    # the streamed file replaces what was staged for it, e.g. the pristine copy of --reset
+    for staged in [k for k in pendingWrites if os.path.normpath(k) == os.path.normpath(f)]:
+        del pendingWrites[staged]
+    if isFile(f) and filecmp.cmp(tmp, f, shallow=False):
+        os.remove(tmp)
+        Message_Debug("   Unchanged " + f)
+        return False
+    fd = os.open(tmp, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if getPlatform() == "Windows" and isFile(f):
+        removeROFlag(f)
+    os.replace(tmp, f)
+    Message_Debug("   Writing " + f)
+    return True
+
+# apply the options to both configuration files in one streaming pass each
+def streamConfigFiles():
+    logger.debug("streamConfigFiles()")
+    Message_Config("   Streaming Directives")
+    actions = optionActions()
+    header = getMetaHeader()
+    found = {}
+    tmps = []
+    doc1 = {"parsed": {}, "added": []}
+    doc2 = {"parsed": {}, "added": []}
+    try:
+        for f in [f_config, f_config_adv]:
+            found[f] = set()
+            if f not in streamed:
+                continue
+            tmps.append((streamWrite(f, streamRewrite(streamHeader(streamSource(f), header), actions, found[f])), f))
+
+        # only the names of the directives (not their lines) are needed to suggest
+        # one for a missing directive, and only read when something is missing
+        seen = found[f_config] | found[f_config_adv]
+        if any(d not in seen and any(k != "disable" for k, v in acts) for d, acts in actions.items()):
+            for tmp, f in tmps:
+                (doc1 if f == f_config else doc2)["parsed"] = streamNames(tmp)
+
+        # report what was found, then deal with what is in neither file
+        fixes.clear()
+        for directive, acts in actions.items():
+            exists = False
+            for f, name in [(f_config, "Configuration.h"), (f_config_adv, "Configuration_adv.h")]:
+                if directive in found[f]:
+                    exists = True
+                    msg = "      " + directive + "".join(" = " + v for k, v in acts if k == "value") + " (" + name + ")"
+                    if silent == True:
+                        logger.info(msg)
+                    else:
+                        Message_Config(msg)
+            for kind, value in acts:
+                metricInc("directives_total", 1, {"action": {"enable": "enabled", "disable": "disabled", "value": "updated"}[kind] if exists else "missing"})
+                if exists:
+                    continue
+                if kind == "disable":
+                    Message_Warning("      " + directive + " not found. Effectively the same as disabled. Skipping.")
+                else:
+                    missingDirective(directive,value,doc1,doc2)
+
+        # --missing fix: a second pass applies the options to the directives they were fixed to
+        fixed = {}
+        for directive, target in fixes.items():
+            fixed.setdefault(target, []).extend((kind, value) for kind, value in actions[directive] if kind != "disable")
+        if fixed:
+            for i, (tmp, f) in enumerate(tmps):
+                tmps[i] = (streamWrite(f, streamRewrite(streamTemp(tmp), fixed, set()), ".fix-"), f)
+        for tmp, f in tmps:
+            added = (doc1 if f == f_config else doc2)["added"]
+            if added:
+                with open(tmp, "at", encoding="utf8") as w:
+                    for name, line in added:
+                        w.write(line)
+        dirs = set()
+        for tmp, f in tmps:
+            if streamFinish(tmp, f):
+                dirs.add(os.path.dirname(os.path.abspath(f)))
+
+        # the other example files (_Bootscreen.h, ...) are copied as they are
+        for f in sorted(streamed):
+            if streamFinish(streamWrite(f, streamSource(f)), f):
+                dirs.add(os.path.dirname(os.path.abspath(f)))
+        for d in sorted(dirs):
+            syncDir(d)
+    except BaseException:
+        for tmp, f in tmps:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        for src, temp in streamed.values():
+            if temp and os.path.exists(src):
+                os.remove(src)
+        raise
+
+#####################################################
+##### FUNCTIONS - WATCH
+#####################################################
+# --watch keeps the documents in memory after the export and, each time the JSON
+# file is saved, re-applies only the directives whose options changed.
+
+watchpoll = 0.05					# seconds between checks when inotify is not available
+
+# the current options as directive -> [(kind, value), ...] in the order they are applied
+def optionActions():
+    actions = {}
+    for key in options_enable:
+        actions.setdefault(str(key), []).append(("enable", None))
+    for key in options_disable:
+        actions.setdefault(str(key), []).append(("disable", None))
+    for key in options_values:
+        actions.setdefault(str(key), []).append(("value", str(options_values[key])))
+    return actions
+
+# put every directive whose actions changed back to stock, then apply its new
+# actions. returns the directives that changed
+def reapplyOptions(applied,actions,doc1,doc2):
+    changed = set(d for d in set(applied) | set(actions) if applied.get(d) != actions.get(d))
+    changed |= set(fixes[d] for d in changed if d in fixes)
+    changed = sorted(changed)
+    for directive in changed:
+        revertDirective(doc1,directive)
+        revertDirective(doc2,directive)
+        fixes.pop(directive, None)
+    for directive in changed:
+        for kind, value in actions.get(directive, []):
+            if not applyOption(directive,kind,value,doc1,doc2):
+                if kind == "disable":
+                    Message_Warning("      " + directive + " not found. Effectively the same as disabled. Skipping.")
+                else:
+                    missingDirective(directive,value,doc1,doc2)
+    return changed
+
+# mtime and size of a file, None if it is missing (e.g. mid-save)
+def fileStamp(f):
+    try:
+        st = os.stat(f)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+# an inotify descriptor watching a directory for finished writes and renames,
+# None when inotify is not available (not linux)
+def inotifyWatch(d):
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(d), 0x08 | 0x80) < 0:		# IN_CLOSE_WRITE | IN_MOVED_TO
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+# read the pending inotify events and return the file names they are for
+def inotifyNames(fd):
+    data = os.read(fd, 65536)
+    names = []
+    pos = 0
+    while pos + 16 <= len(data):
+        wd, mask, cookie, size = struct.unpack_from("iIII", data, pos)
+        names.append(data[pos + 16:pos + 16 + size].rstrip(b"\0"))
+        pos += 16 + size
+    return names
+
+# yield each time a file has been saved. the directory is watched because most
+# editors save by renaming a new file over the old one.
+def watchFile(f):
+    fd = inotifyWatch(os.path.dirname(os.path.abspath(f)))
+    if fd is None:
+        Message_Debug("   inotify not available, polling every " + str(watchpoll) + "s")
+        last = fileStamp(f)
+        while True:
+            time.sleep(watchpoll)
+            stamp = fileStamp(f)
+            if stamp != last and stamp is not None:
+                last = stamp
+                yield
+    name = os.fsencode(os.path.basename(f))
+    try:
+        while True:
+            select.select([fd], [], [])
+            if name in inotifyNames(fd):
+                # swallow the rest of the burst a single save produces
+                while select.select([fd], [], [], 0.01)[0]:
+                    inotifyNames(fd)
+                yield
+    finally:
+        os.close(fd)
+
+# re-apply the options of the JSON file every time it changes, until ctrl-c
+def runWatch():
+    logger.debug("runWatch()")
+    global options_enable
+    global options_disable
+    global options_values
+    print()
+    Message_Header("Watching " + JSONFile + " for changes (ctrl-c to stop)")
+
+    doc1 = getDocument(f_config)
+    doc2 = getDocument(f_config_adv)
+    applied = optionActions()
+    example = None
+    try:
+        with open(JSONFile,encoding="utf8") as r:
+            example = json.load(r).get('useExample')
+    except (IOError, ValueError):
+        pass
+
+    try:
+        for _ in watchFile(JSONFile):
+            start = time.perf_counter()
+            try:
+                with open(JSONFile,encoding="utf8") as r:
+                    rdata = json.load(r)
+            except (IOError, ValueError) as e:
+                Message_Warning("   " + JSONFile + " is not valid JSON (" + str(e) + "). Waiting for the next save.")
+                continue
+            if rdata.get('useExample') != example:
+                Message_Warning("   useExample changed. Only the options are watched, restart to use the new example.")
+            options = rdata.get('options') or {}
+            options_enable = options.get('enable') or []
+            options_disable = options.get('disable') or []
+            options_values = options.get('values') or {}
+
+            actions = optionActions()
+            changed = reapplyOptions(applied,actions,doc1,doc2)
+            applied = actions
+
+            if len(changed) > 0:
+                saveDocument(f_config)
+                saveDocument(f_config_adv)
+                commitWrites()
+                writeManifest()
+                recordDirectives()
+            Message_Config("   " + str(len(changed)) + " directive(s) changed, applied in " + "%.1f" % ((time.perf_counter() - start) * 1000) + " ms")
+    except KeyboardInterrupt:
+        print()
+        Message_Config("   Stopped watching " + JSONFile)
+
+#####################################################
+##### FUNCTIONS - DELTA RE-APPLICATION
+#####################################################
+# every export leaves a manifest next to the configuration files with the hash
+# of the example they were made from, the options that were applied and the
+# hash of what was written. when the next export uses the same example and the
+# files were not edited since, the previous output is loaded instead of the
+# stock files and only the directives whose options changed are reverted to
+# stock and applied again. anything else is a full rebuild.
+
+deltaversion = 1					# bump when the manifest format changes
+
+def manifestPath():
+    return targetdir + "/Marlin/.marlin-configurator.json"
+
+# the settings that change how options are applied, a change means a full rebuild
+def deltaSettings():
+    return [version, missing, distance]
+
+# the text of a file as it is on disk, None if it can not be read
+def diskText(f):
+    try:
+        with open(f, "rb") as fh:
+            data = fh.read()
+    except OSError:
+        return None
+    text = data.decode("utf8", "replace")
+    if os.linesep != "\n":
+        text = text.replace(os.linesep, "\n")
+    return (hashData(data), text)
+
+# load the previous output of the configuration files into their documents and
+# re-apply only the options that changed. False when a full rebuild is needed
+def applyDelta():
+    logger.debug("applyDelta()")
+    global fixes
+    try:
+        with open(manifestPath(), "rt", encoding="utf8") as r:
+            manifest = json.load(r)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('version') != deltaversion or manifest.get('settings') != deltaSettings():
+        return False
+
+    header = getMetaHeader()
+    hn = len(header.splitlines(True))
+    docs = []
+    for f in [f_config, f_config_adv]:
+        entry = manifest.get('files', {}).get(os.path.basename(f))
+        if entry is None or not isFileStaged(f):
+            return False
+        text = readFile(f)
+        if not text.startswith(header) or hashData(text[len(header):].encode("utf8")) != entry['stock']:
+            Message_Config("   The example changed since the last export, applying all options")
+            return False
+        out = diskText(f)
+        if out is None or out[0] != entry['output']:
+            Message_Warning("   " + f + " changed since the last export, applying all options")
+            return False
+        doc = textDocument(text)
+        body = out[1].splitlines(True)[entry['header']:entry['lines']]
+        if len(body) != len(doc["lines"]) - hn:
+            return False
+        doc["lines"] = doc["lines"][:hn] + body
+        doc["added"] = [tuple(a) for a in entry['added']]
+        docs.append(doc)
+
+    documents[f_config], documents[f_config_adv] = docs
+    fixes = dict(manifest.get('fixes', {}))
+    applied = dict((d, [tuple(a) for a in acts]) for d, acts in manifest.get('actions', {}).items())
+    changed = reapplyOptions(applied,optionActions(),docs[0],docs[1])
+    saveDocument(f_config)
+    saveDocument(f_config_adv)
+    metricInc("delta_exports_total")
+    Message_Config("   " + str(len(changed)) + " directive(s) changed since the last export")
+    return True
+
+# record what the configuration files were made from, after they are written
+def writeManifest():
+    logger.debug("writeManifest()")
+    header = getMetaHeader()
+    manifest = {"version": deltaversion, "settings": deltaSettings(), "files": {}, "fixes": fixes,
+                "actions": dict((d, [list(a) for a in acts]) for d, acts in optionActions().items())}
+    for f in [f_config, f_config_adv]:
+        doc = getDocument(f)
+        source = "".join(doc["source"])
+        out = diskText(f)
+        if out is None or not source.startswith(header):
+            return
+        manifest['files'][os.path.basename(f)] = {
+            "stock": hashData(source[len(header):].encode("utf8")),
+            "output": out[0],
+            "header": len(header.splitlines(True)),
+            "lines": len(doc["lines"]),
+            "added": [list(a) for a in doc["added"]]
+        }
+    try:
+        atomicWrite(manifestPath(), json.dumps(manifest, indent=1, sort_keys=True).encode("utf8"))
+    except OSError as e:
+        Message_Warning("   Unable to write " + manifestPath() + ": " + str(e))
+
+#####################################################
+##### FUNCTIONS - EXTRACT
+#####################################################
+# reverse mode: diff hand edited Configuration.h / Configuration_adv.h files
+# against the stock example and write the minimal JSON options that rebuild them.
+
+configfiles = ['Configuration.h', 'Configuration_adv.h']
+
+# read one stock example file from --importpath or from useExample
+def readExampleFile(name):
+    if importpath != 'None':
+        with open(os.path.join(importpath, name), encoding="utf8") as r:
+            return r.read()
+    text = getWebFile(URL + "/" + name)
+    if text is None:
+        ExitStageLeft(404,"The stock " + name + " is needed to compare against")
+    return text
+
+# directive states of a set of files, merged (the options apply to both files).
+# parsed without the cache: these are user files and old releases, whose entries
+# storeFlush() would drop again straight away
+def fileStates(texts):
+    states = {}
+    for text in texts:
+        for name, state in directiveStates(parseDirectives(text)).items():
+            if name not in states or (state[0] and not states[name][0]):
+                states[name] = state
+    return states
+
+# options that turn the stock states into the modified states
+def diffStates(stock,modified):
+    enable = {}
+    disable = {}
+    values = {}
+    added = []
+    for name in sorted(modified):
+        enabled, value = modified[name]
+        if name not in stock:
+            if enabled:
+                added.append(name)
+                if value:
+                    values[name] = value
+                else:
+                    enable[name] = True
+            continue
+        s_enabled, s_value = stock[name]
+        if enabled and (value != s_value):
+            values[name] = value
+        elif enabled and not s_enabled:
+            enable[name] = True
+        elif s_enabled and not enabled:
+            disable[name] = False
+    for name in sorted(stock):
+        if stock[name][0] and name not in modified:
+            disable[name] = False
+    return {"enable": enable, "disable": disable, "values": values}, added
+
+# the modified files of one printer: a single header or a directory holding them
+def extractSources(src):
+    if isFile(src):
+        return [src]
+    return [os.path.join(src, name) for name in configfiles if isFile(os.path.join(src, name))]
+
+# every printer directory below src (a directory with a Configuration.h or _adv.h in it)
+def findExtractSources(src):
+    if isFile(src):
+        return [src]
+    found = []
+    for root, dirs, names in os.walk(src):
+        dirs.sort()
+        if any(name in names for name in configfiles):
+            found.append(root)
+    return found
+
+# stock states shared with the worker processes
+extractStock = {}
+
+def setExtractStock(stock):
+    global extractStock
+    extractStock = stock
+
+# worker: extract the options of one printer. returns (src, options, added, error)
+def extractOne(src):
+    try:
+        sources = extractSources(src)
+        texts = []
+        for f in sources:
+            with open(f, encoding="utf8", errors="replace") as r:
+                texts.append(r.read())
+        stock = extractStock.get("all", {})
+        if len(sources) == 1:
+            stock = extractStock.get(os.path.basename(sources[0]), stock)
+        options, added = diffStates(stock, fileStates(texts))
+        return (src, options, added, None)
+    except Exception as e: ##error message
+        return (src, None, [], str(e))
+
+# --opmode extract
+def runExtract(source,output):
+    logger.debug("runExtract()")
+    if source == 'None':
+        ExitStageLeft(400,"--opmode extract needs --source (a header file, a printer directory, or a directory of printers)")
+    if importpath == 'None' and JSONFile == 'None':
+        ExitStageLeft(400,"--opmode extract needs the stock example from --importpath or useExample in --config")
+    Message_Header("Extracting JSON options from " + source)
+
+    # parse the stock example once
+    stock = {}
+    texts = []
+    for name in configfiles:
+        text = readExampleFile(name)
+        stock[name] = fileStates([text])
+        texts.append(text)
+    stock["all"] = fileStates(texts)
+
+    sources = findExtractSources(source)
+    if not sources:
+        ExitStageLeft(404,"No Configuration.h or Configuration_adv.h found in " + source)
+    if len(sources) == 1:
+        setExtractStock(stock)
+        results = [extractOne(sources[0])]
+    else:
+        with ProcessPoolExecutor(initializer=setExtractStock, initargs=(stock,)) as pool:
+            results = list(pool.map(extractOne, sources, chunksize=8))
+
+    for src, options, added, error in results:
+        if error:
+            Message_Error("   " + src + ": " + error)
+            continue
+        data = {"options": options}
+        if importpath == 'None':
+            data = {"useExample": {"branch": branch, "path": path, "files": files}, "options": options}
+        text = json.dumps(data, indent=2) + "\n"
+        if added:
+            Message_Warning("   " + src + ": not in the example, needs --missing add: " + ", ".join(added))
+        if len(results) == 1:
+            # one printer: --output is the json file, stdout if not set
+            if output == 'None':
+                print(text)
+                continue
+            jfile = output
+        else:
+            # many printers: one json file per printer directory in --output
+            rel = os.path.relpath(src, source)
+            jfile = os.path.join(output if output != 'None' else "user/extracted", rel.replace(os.sep, "_").replace(" ", "_") + ".json")
+        Message_Config("   " + src + " -> " + jfile + " (" + str(len(options['enable'])) + " enable, " + str(len(options['disable'])) + " disable, " + str(len(options['values'])) + " values)")
+        os.makedirs(os.path.dirname(os.path.abspath(jfile)), exist_ok=True)
+        writeFile(jfile, text)
+    commitWrites()
+
+#####################################################
+##### FUNCTIONS - REBASE
+#####################################################
+# move customized headers to a new example (e.g. a new Marlin release) with a
+# directive level three-way merge. the customizations are the options that turn
+# the old stock example into the current headers (as in extract); they are
+# applied to the new stock example, whatever file each directive now lives in.
+# a directive that was changed both by us and upstream is a conflict: our value
+# is kept and the conflict is reported in rebase.json next to the new headers.
+
+# read one file of the new example from a directory or a branch/commit of useExample.path
+def readOntoFile(onto,name):
+    if isDir(onto):
+        with open(os.path.join(onto, name), encoding="utf8") as r:
+            return r.read()
+    text = getWebFile(exampleURL(onto,path) + "/" + name)
+    if text is None:
+        ExitStageLeft(404,"The new stock " + name + " is needed to rebase onto")
+    return text
+
+# short text of a state for the report
+def stateText(state):
+    if state is None:
+        return "missing"
+    return ("enabled" if state[0] else "disabled") + (" " + state[1] if state[1] else "")
+
+# true if a stock state already has the effect of an action
+def isConverged(kind,value,state):
+    if kind == "disable":
+        return not state[0]
+    if kind == "enable":
+        return state[0]
+    return state[0] and state[1] == value
+
+# the actions that carry our changes over to the new example, and the report
+def rebaseStates(base,ours,theirs):
+    options, added = diffStates(base, ours)
+    actions = {}
+    report = {"applied": [], "conflicts": [], "dropped": [], "custom": []}
+    changes = [(n, "enable", None) for n in options['enable']] + [(n, "disable", None) for n in options['disable']] + [(n, "value", v) for n, v in options['values'].items()]
+    for name, kind, value in sorted(changes):
+        if name not in theirs:
+            if name in added:
+                # our own directive, carried over as an added line
+                actions[name] = (kind, value)
+                report["custom"].append(name)
+            else:
+                # removed or renamed upstream
+                report["dropped"].append({"directive": name, "base": stateText(base.get(name)), "ours": stateText(ours.get(name))})
+            continue
+        # enabling keeps the value of the file it is applied to. when upstream changed
+        # that value, set ours instead, so the result is what the report says
+        if kind == "enable" and ours.get(name) and ours[name][1] and theirs[name][1] != ours[name][1]:
+            kind, value = "value", ours[name][1]
+        if isConverged(kind, value, theirs[name]):
+            continue
+        if name in base and theirs[name] != base[name]:
+            report["conflicts"].append({"directive": name, "base": stateText(base[name]), "ours": stateText(ours.get(name)), "theirs": stateText(theirs[name]), "resolution": "ours"})
+        actions[name] = (kind, value)
+        report["applied"].append(name)
+    return actions, report
+
+# stock data shared with the worker processes
+rebaseStock = {}
+
+def setRebaseStock(stock):
+    global rebaseStock
+    rebaseStock = stock
+
+# worker: rebase one printer. returns (src, {file: text}, report, error)
+def rebaseOne(src):
+    try:
+        texts = []
+        for f in extractSources(src):
+            with open(f, encoding="utf8", errors="replace") as r:
+                texts.append(r.read())
+        actions, report = rebaseStates(rebaseStock["base"], fileStates(texts), rebaseStock["theirs"])
+        docs = {}
+        for name in configfiles:
+            doc = rebaseStock["docs"][name]
+            docs[name] = {"source": doc["source"], "lines": list(doc["lines"]), "parsed": doc["parsed"], "added": []}
+        doc1 = docs[configfiles[0]]
+        doc2 = docs[configfiles[1]]
+        for directive, (kind, value) in sorted(actions.items()):
+            found = applyDirective(doc1, directive, kind, value)
+            found = applyDirective(doc2, directive, kind, value) or found
+            if not found and kind != "disable":
+                doc1["added"].append((directive, missingLine(directive, value)))
+        return (src, dict((name, renderDocument(docs[name])) for name in configfiles), report, None)
+    except Exception as e: ##error message
+        return (src, None, None, str(e))
+
+# --opmode rebase
+def runRebase(source,onto,output):
+    logger.debug("runRebase()")
+    if source == 'None':
+        ExitStageLeft(400,"--opmode rebase needs --source (a printer directory, or a directory of printers)")
+    if onto == 'None':
+        ExitStageLeft(400,"--opmode rebase needs --onto (a directory with the new stock example, or a branch/commit of useExample.path)")
+    if importpath == 'None' and JSONFile == 'None':
+        ExitStageLeft(400,"--opmode rebase needs the old stock example from --importpath or useExample in --config")
+    Message_Header("Rebasing " + source + " onto " + onto)
+
+    # parse both stock examples once
+    base = []
+    theirs = []
+    docs = {}
+    for name in configfiles:
+        base.append(readExampleFile(name))
+        text = readOntoFile(onto, name)
+        theirs.append(text)
+        docs[name] = textDocument(text)
+    stock = {"base": fileStates(base), "theirs": fileStates(theirs), "docs": docs}
+
+    sources = [s for s in findExtractSources(source) if not isFile(s)]
+    if not sources:
+        ExitStageLeft(404,"No printer directory with a Configuration.h or Configuration_adv.h found in " + source)
+    if len(sources) == 1:
+        setRebaseStock(stock)
+        results = [rebaseOne(sources[0])]
+    else:
+        with ProcessPoolExecutor(initializer=setRebaseStock, initargs=(stock,)) as pool:
+            results = list(pool.map(rebaseOne, sources, chunksize=8))
+
+    if output == 'None':
+        output = "user/rebased"
+    conflicts = 0
+    for src, texts, report, error in results:
+        if error:
+            Message_Error("   " + src + ": " + error)
+            continue
+        outdir = output if len(results) == 1 else os.path.join(output, os.path.relpath(src, source))
+        os.makedirs(outdir, exist_ok=True)
+        for name, text in texts.items():
+            writeFile(os.path.join(outdir, name), text)
+        report = dict(report, source=src, onto=onto)
+        writeFile(os.path.join(outdir, "rebase.json"), json.dumps(report, indent=2) + "\n")
+        conflicts += len(report["conflicts"])
+        msg = "   " + src + " -> " + outdir + " (" + str(len(report["applied"])) + " applied, " + str(len(report["conflicts"])) + " conflicts, " + str(len(report["dropped"])) + " dropped, " + str(len(report["custom"])) + " custom)"
+        if report["conflicts"] or report["dropped"]:
+            Message_Warning(msg)
+        else:
+            Message_Config(msg)
+        for c in report["conflicts"]:
+            Message_Warning("      " + c["directive"] + ": was " + c["base"] + ", ours " + c["ours"] + ", new example " + c["theirs"] + ". Kept ours.")
+        for d in report["dropped"]:
+            Message_Warning("      " + d["directive"] + ": not in the new example, dropped (ours " + d["ours"] + ")")
+    commitWrites()
+    if conflicts:
+        Message_Warning("   " + str(conflicts) + " conflicts, see rebase.json in the output")
+
+#####################################################
+##### FUNCTIONS - FIRMWARE BUILD
+#####################################################
+# builds are cached in cachedir/artifacts/<key> where the key hashes the
+# generated headers, the marlin commit, the platformio env and the build
+# command. identical configurations on the same commit are built only once.
+
+# commit of the marlin tree in the target, "unknown" if it is not a git checkout
+def getMarlinCommit(d):
+    try:
+        r = subprocess.run(["git", "-C", d, "rev-parse", "HEAD"], capture_output=True, text=True)
+        if r.returncode == 0:
+            return r.stdout.strip()
+    except OSError:
+        pass
+    return "unknown"
+
+# key of the artifact store for the current configuration
+def getBuildKey():
+    key = hashlib.sha256()
+    key.update(("commit:" + getMarlinCommit(targetdir) + "\nenv:" + str(buildenv) + "\ncmd:" + str(buildcmd) + "\n").encode("utf8"))
+    for name in sorted(files):
+        f = os.path.join(targetdir, "Marlin", name)
+        if isFile(f):
+            with open(f, "rb") as fh:
+                data = fh.read()
+            # without our meta header, it names the target and the JSON file
+            data = splitMetaHeader(data.decode("utf8", "replace").replace("\r\n", "\n"))[1].encode("utf8")
+            key.update(("file:" + name + ":" + str(len(data)) + "\n").encode("utf8"))
+            key.update(data)
+    return key.hexdigest()
+
+# build artifact files in the target after a build
+def findBuildArtifacts():
+    found = []
+    for pattern in buildartifacts:
+        found += glob.glob(os.path.join(targetdir, pattern.replace("{env}", str(buildenv))))
+    return sorted(set(found))
+
+# copy a file into place atomically
+def copyFile(src,dst):
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    tmp = dst + ".tmp-" + str(os.getpid())
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+# build the firmware, or reuse the cached artifacts of an identical build
+def buildFirmware():
+    logger.debug("buildFirmware()")
+    Message_Header("Building Firmware")
+    if str(buildenv) == 'None':
+        ExitStageLeft(400,"Building the firmware needs --buildenv (the platformio environment)")
+    key = getBuildKey()
+    artifactdir = os.path.join(cachedir, "artifacts", key)
+    Message_Config("   build key " + key)
+
+    try:
+        # cache hit: put the stored artifacts back where the build would have left them
+        if storeEnabled() and isFile(os.path.join(artifactdir, "artifacts.json")):
+            with open(os.path.join(artifactdir, "artifacts.json"), encoding="utf8") as r:
+                stored = json.load(r)
+            for rel in stored['artifacts']:
+                copyFile(os.path.join(artifactdir, os.path.basename(rel)), os.path.join(targetdir, rel))
+                Message_Config("   Using cached " + rel)
+            metricInc("builds_total", 1, {"result": "cached"})
+            return
+
+        # cache miss: run the build command and keep its log
+        cmd = str(buildcmd).replace("{env}", str(buildenv)).replace("{targetdir}", str(targetdir))
+        Message_Config("   Running " + cmd + " in " + str(targetdir))
+        for f in findBuildArtifacts():
+            rmFile(f)	# never mistake a stale artifact for the result of this build
+        r = subprocess.run(cmd, shell=True, cwd=targetdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        buildlog = r.stdout
+        artifacts = findBuildArtifacts()
+        if r.returncode != 0 or not artifacts:
+            metricInc("builds_total", 1, {"result": "failed"})
+            buildlogfile = os.path.join(targetdir, "build-" + str(buildenv) + ".log")
+            atomicWrite(buildlogfile, buildlog)
+            ExitStageLeft(r.returncode or 500,"Build failed (exit code " + str(r.returncode) + ", " + str(len(artifacts)) + " artifacts). See " + buildlogfile)
+        metricInc("builds_total", 1, {"result": "built"})
+        for f in artifacts:
+            Message_Config("   Built " + os.path.relpath(f, targetdir))
+        if not storeEnabled():
+            return
+
+        # store the artifacts; a build that raced us to the same key wins
+        tmpdir = artifactdir + ".tmp-" + str(os.getpid())
+        os.makedirs(tmpdir, exist_ok=True)
+        rels = []
+        for f in artifacts:
+            shutil.copy2(f, os.path.join(tmpdir, os.path.basename(f)))
+            rels.append(os.path.relpath(f, targetdir).replace(os.sep, "/"))
+        with open(os.path.join(tmpdir, "build.log"), "wb") as fh:
+            fh.write(buildlog)
+        with open(os.path.join(tmpdir, "artifacts.json"), "w", encoding="utf8") as fh:
+            json.dump({"artifacts": rels, "env": buildenv, "commit": getMarlinCommit(targetdir), "cmd": cmd}, fh, indent=1)
+        try:
+            os.replace(tmpdir, artifactdir)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    except IOError as ioe: ##error message
+        Message_Exception("IOError Occured in buildFirmware",ioe)
+    except Exception as e: ##error message
+        Message_Exception("Exception Occured in buildFirmware",e)
+
+#####################################################
+##### FUNCTIONS - CONFIGURATION RESET
+#####################################################
+# replaces the legacy 'git reset --hard' of the whole marlin tree. only the
+# configuration files are compared with the commit (by git blob hash) and only
+# the ones that differ are restored, so the rest of the tree and its mtimes
+# (and the build cache that depends on them) are left alone.
+
+# git's object id of some bytes, so files can be compared without running git
+def gitBlobHash(data):
+    return hashlib.sha1(("blob " + str(len(data)) + "\0").encode("utf8") + data).hexdigest()
+
+# the configuration files of the commit: relpath -> {git, sha256}, cached per commit
+def getPristineSnapshot(commit):
+    snapfile = os.path.join(cachedir, "pristine", commit + ".json")
+    if storeEnabled() and isFile(snapfile):
+        with open(snapfile, encoding="utf8") as r:
+            return json.load(r)
+    r = git(["ls-tree", commit, "Marlin/"], targetdir)
+    if r.returncode != 0:
+        raise Exception("git ls-tree failed: " + r.stderr.strip())
+    snapshot = {}
+    names = set(['_Bootscreen.h', '_Statusscreen.h'] + list(files))
+    for line in r.stdout.splitlines():
+        meta, rel = line.split("\t", 1)
+        mode, kind, githash = meta.split()
+        name = rel[len("Marlin/"):]
+        if kind != "blob" or not (name in names or (name.startswith("Configuration") and name.endswith(".h"))):
+            continue
+        data = subprocess.run(["git", "cat-file", "blob", githash], cwd=targetdir, capture_output=True).stdout
+        snapshot[rel] = {"git": githash, "sha256": storePut(data)}
+    if storeEnabled():
+        os.makedirs(os.path.dirname(snapfile), exist_ok=True)
+        atomicWrite(snapfile, json.dumps(snapshot, indent=1, sort_keys=True).encode("utf8"))
+    return snapshot
+
+# stage the pristine version of every configuration file that was changed
+def resetConfigFiles():
+    logger.debug("resetConfigFiles()")
+    Message_Header("Restoring pristine configuration files")
+    commit = getMarlinCommit(targetdir)
+    if commit == "unknown":
+        Message_Warning("   " + str(targetdir) + " is not a git checkout. Nothing to reset.")
+        return
+    try:
+        snapshot = getPristineSnapshot(commit)
+        restored = 0
+        for rel in sorted(snapshot):
+            f = os.path.join(targetdir, rel)
+            if isFile(f):
+                with open(f, "rb") as fh:
+                    if gitBlobHash(fh.read()) == snapshot[rel]["git"]:
+                        continue
+            data = storeGet(snapshot[rel]["sha256"])
+            if data is None:
+                data = subprocess.run(["git", "cat-file", "blob", snapshot[rel]["git"]], cwd=targetdir, capture_output=True).stdout
+            Message_Config("   restoring " + rel)
+            writeFile(f, data.decode("utf8", "replace").replace("\r\n", "\n"))
+            restored += 1
+        metricInc("files_reset_total", restored)
+        Message_Config("   " + str(restored) + " of " + str(len(snapshot)) + " configuration files restored to " + commit[:12])
+    except IOError as ioe: ##error message
+        Message_Exception("IOError Occured in resetConfigFiles",ioe)
+    except Exception as e: ##error message
+        Message_Exception("Exception Occured in resetConfigFiles",e)
+
+#####################################################
+##### FUNCTIONS - FLEET SCHEDULER
+#####################################################
+# generate (and build) many JSON configurations at once. every job runs in its
+# own git worktree of the marlin clone, taken from a pool of worktrees that are
+# reused between jobs (and runs) so their .pio build directories stay warm.
+
+# run git, returns the completed process
+def git(args,cwd=None):
+    return subprocess.run(["git"] + args, cwd=cwd, capture_output=True, text=True)
+
+# number of parallel jobs that fit in the cpus and the available memory
+def getFleetWorkers(count):
+    workers = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo") as r:
+            for line in r:
+                if line.startswith("MemAvailable:"):
+                    workers = min(workers, max(1, int(line.split()[1]) // 1024 // jobmem))
+    except (OSError, ValueError):
+        pass	# not linux, only the cpus count
+    return max(1, min(workers, count))
+
+# the JSON configurations of the fleet: one file or every .json below a directory
+def findFleetJobs(src):
+    if isFile(src):
+        return [src]
+    found = []
+    for root, dirs, names in os.walk(src):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(".json"):
+                found.append(os.path.join(root, name))
+    return found
+
+# a unique name for a job, from its path below source
+def fleetJobName(job,source,names):
+    name = os.path.splitext(os.path.relpath(job, source) if job != source else os.path.basename(job))[0]
+    name = name.replace(os.sep, "_").replace(" ", "_")
+    while name in names:
+        name += "_"
+    names.add(name)
+    return name
+
+# worktree slots, created on demand and handed out to one job at a time. other
+# runs on the machine (e.g. several workers) share the worktrees directory, so
+# each slot we use is locked by its slot-N.lock until releaseFleetSlots()
+fleetSlots = queue.Queue()
+fleetSlotLock = threading.Lock()
+fleetSlotLocks = {}					# slot -> handle of its lock file
+fleetSlotCount = 0					# scratch slots made by this run, see getScratchSlot()
+
+# take a worktree checked out at commit, creating one if the pool is empty
+def getFleetSlot(commit):
+    try:
+        slot = fleetSlots.get_nowait()
+    except queue.Empty:
+        with fleetSlotLock:
+            base = os.path.join(cachedir, "worktrees", hashData(os.path.abspath(marlinrepo).encode("utf8"))[:12])
+            os.makedirs(base, exist_ok=True)
+            # the first slot no other run is using
+            n = 0
+            while True:
+                n += 1
+                slot = os.path.join(base, "slot-" + str(n))
+                fh = None if slot in fleetSlotLocks else tryLockFile(slot + ".lock")
+                if fh:
+                    break
+            fleetSlotLocks[slot] = fh
+            if not isDir(os.path.join(slot, "Marlin")):
+                lock = lockFile(os.path.join(base, "worktrees.lock"))	# git does not like concurrent worktree changes
+                try:
+                    if isDir(slot):
+                        shutil.rmtree(slot)
+                    git(["worktree", "prune"], marlinrepo)
+                    r = git(["worktree", "add", "--detach", os.path.abspath(slot), commit], marlinrepo)
+                    if r.returncode != 0:
+                        raise Exception("git worktree add failed: " + r.stderr.strip())
+                finally:
+                    unlockFile(lock)
+    # back to a pristine checkout of the commit. untracked files of the previous
+    # job (_Bootscreen.h, the manifest, ...) are removed, the build output (.pio) is kept.
+    r = git(["checkout", "-q", "-f", "--detach", commit], slot)
+    if r.returncode != 0:
+        raise Exception("git checkout in " + slot + " failed: " + r.stderr.strip())
+    r = git(["clean", "-q", "-f", "-d", "-x", "-e", ".pio"], slot)
+    if r.returncode != 0:
+        raise Exception("git clean in " + slot + " failed: " + r.stderr.strip())
+    for f in glob.glob(os.path.join(slot, ".pio", "build", "*", "firmware*")):
+        os.remove(f)
+    return slot
+
+# an empty target directory for a job that is not built, used when there is no
+# marlin clone. taken from the same pool as the worktrees
+def getScratchSlot():
+    global fleetSlotCount
+    try:
+        slot = fleetSlots.get_nowait()
+    except queue.Empty:
+        with fleetSlotLock:
+            fleetSlotCount += 1
+            slot = os.path.join(cachedir, "scratch", str(os.getpid()) + "-" + str(fleetSlotCount))
+    if isDir(slot):
+        shutil.rmtree(slot)
+    os.makedirs(os.path.join(slot, "Marlin"))
+    return slot
+
+# hand our worktree slots over to other runs and remove our scratch directories.
+# the worktrees stay, so later jobs build on their warm build directories
+def releaseFleetSlots():
+    with fleetSlotLock:
+        while not fleetSlots.empty():
+            fleetSlots.get_nowait()
+        for slot, fh in fleetSlotLocks.items():
+            unlockFile(fh)
+        fleetSlotLocks.clear()
+    for slot in glob.glob(os.path.join(cachedir, "scratch", str(os.getpid()) + "-*")):
+        shutil.rmtree(slot, ignore_errors=True)
+
+# run one job in a worktree (or a scratch directory when commit is None), collect
+# its headers, artifacts and log in outdir
+def runFleetJob(job,name,commit,outdir,passargs,log=None):
+    start = time.monotonic()
+    jobdir = os.path.join(outdir, name)
+    os.makedirs(jobdir, exist_ok=True)
+    result = {"job": job, "name": name, "status": "failed", "seconds": 0, "artifacts": []}
+    slot = None
+    try:
+        slot = getFleetSlot(commit) if commit else getScratchSlot()
+        cmd = [sys.executable, "marlin-configurator.py", "--config", job, "--target", slot, "--force", "True", "--createdir", "True", "--cachedir", cachedir] + passargs
+        if commit:
+            cmd += ["--marlin", marlinrepo]	# the history hints of the clone the slot is checked out from
+        with open(log or os.path.join(jobdir, "run.log"), "wb") as fh:
+            r = subprocess.run(cmd, stdout=fh, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        result["exitcode"] = r.returncode
+        for f in sorted(glob.glob(os.path.join(slot, "Marlin", "Configuration*.h")) + glob.glob(os.path.join(slot, "Marlin", "_*.h"))):
+            copyFile(f, os.path.join(jobdir, os.path.basename(f)))
+        for pattern in buildartifacts:
+            for f in sorted(glob.glob(os.path.join(slot, pattern.replace("{env}", "*")))):
+                copyFile(f, os.path.join(jobdir, os.path.basename(f)))
+                result["artifacts"].append(os.path.basename(f))
+        if r.returncode == 0:
+            result["status"] = "ok"
+    except Exception as e: ##error message
+        result["error"] = str(e)
+        logger.exception(e)
+    finally:
+        if slot:
+            fleetSlots.put(slot)
+    result["seconds"] = round(time.monotonic() - start, 2)
+    return result
+
+# --opmode fleet
+def runFleet(source,output,workers,passargs):
+    logger.debug("runFleet()")
+    if source == 'None':
+        ExitStageLeft(400,"--opmode fleet needs --source (a JSON configuration or a directory of them)")
+    if marlinrepo == 'None' or not isDir(os.path.join(marlinrepo, ".git")) and not isFile(os.path.join(marlinrepo, ".git")):
+        ExitStageLeft(400,"--opmode fleet needs --marlin pointing at a local Marlin git clone")
+    if not storeEnabled():
+        ExitStageLeft(400,"--opmode fleet keeps its worktrees in the cache, --cachedir can not be None")
+    jobs = findFleetJobs(source)
+    if not jobs:
+        ExitStageLeft(404,"No JSON configurations found in " + source)
+    commit = getMarlinCommit(marlinrepo)
+    outdir = output if output != 'None' else "fleet"
+    if workers < 1:
+        workers = getFleetWorkers(len(jobs))
+    Message_Header("Fleet: " + str(len(jobs)) + " jobs on " + str(workers) + " workers, Marlin " + commit[:12])
+
+    results = []
+    names = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for job in jobs:
+            name = fleetJobName(job, source, names)
+            futures.append(pool.submit(runFleetJob, job, name, commit, outdir, passargs))
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            msg = "   " + result["name"] + ": " + result["status"] + " in " + str(result["seconds"]) + "s"
+            if result["artifacts"]:
+                msg += " (" + ", ".join(result["artifacts"]) + ")"
+            if result["status"] == "ok":
+                Message_Config(msg)
+            else:
+                Message_Error(msg + " see " + os.path.join(outdir, result["name"], "run.log"))
+            metricInc("fleet_jobs_total", 1, {"status": result["status"]})
+    releaseFleetSlots()
+    os.makedirs(outdir, exist_ok=True)
+    atomicWrite(os.path.join(outdir, "fleet.json"), json.dumps({"commit": commit, "workers": workers, "jobs": results}, indent=1).encode("utf8"))
+    failed = len([r for r in results if r["status"] != "ok"])
+    if failed:
+        ExitStageLeft(1,str(failed) + " of " + str(len(results)) + " fleet jobs failed")
+
+#####################################################
+##### FUNCTIONS - WORK QUEUE
+#####################################################
+# --opmode worker runs the jobs of a queue directory shared by several machines
+# (nfs, smb, ...), --opmode enqueue adds them. a job is a small JSON file that
+# moves from pending/ to claimed/ with a rename, which only one worker can win,
+# and from there to done/ or failed/ with its result. while it runs its worker
+# touches a lease file next to it. a job whose lease is older than leasetime was
+# lost with its worker and goes back to pending/, up to maxattempts times.
+# headers and firmware go to results/<job>/, the output of the run to logs/.
+
+leasetime = 600						# seconds without a heartbeat before a claimed job is taken back
+maxattempts = 3						# times a job is taken back before it is failed
+queuepoll = 5						# seconds between looks at the queue while other workers finish
+queuedirs = ["pending", "claimed", "done", "failed", "logs", "results"]
+
+# who we are in the leases and results
+def workerId():
+    return socket.gethostname() + "-" + str(os.getpid())
+
+def queueFile(q,d,name):
+    return os.path.join(q, d, name)
+
+def leasePath(q,name):
+    return queueFile(q, "claimed", name[:-len(".json")] + ".lease")
+
+# the job files of a queue directory, oldest name first
+def queueJobs(q,d):
+    try:
+        return sorted(n for n in os.listdir(os.path.join(q, d)) if n.endswith(".json") and not n.startswith("."))
+    except OSError:
+        return []
+
+def writeJob(q,d,name,job):
+    atomicWrite(queueFile(q, d, name), json.dumps(job, indent=1).encode("utf8"))
+
+def readJob(f):
+    with open(f, "rt", encoding="utf8") as r:
+        return json.load(r)
+
+# seconds since the last sign of life of a claimed job. the rename into claimed/
+# sets its ctime, so a job is safe in the moment before its lease is written
+def leaseAge(q,name):
+    stamps = []
+    for f in [leasePath(q, name), queueFile(q, "claimed", name)]:
+        try:
+            st = os.stat(f)
+            stamps += [st.st_mtime, st.st_ctime]
+        except OSError:
+            pass
+    return time.time() - max(stamps) if stamps else 0
+
+# seconds since a file was last written or renamed, 0 if it is gone
+def fileAge(f):
+    try:
+        st = os.stat(f)
+    except OSError:
+        return 0
+    return time.time() - max(st.st_mtime, st.st_ctime)
+
+# put the jobs of lost workers back into pending/ (or failed/ after maxattempts).
+# a job is first renamed to name.recover-<worker> so only one worker recovers it,
+# a worker that died in between leaves that file behind for the next one
+def recoverJobs(q):
+    lost = [(name, name) for name in queueJobs(q, "claimed") if leaseAge(q, name) >= leasetime]
+    for f in sorted(glob.glob(queueFile(q, "claimed", "*.json.recover-*"))):
+        if fileAge(f) >= leasetime:
+            lost.append((os.path.basename(f), os.path.basename(f).split(".recover-")[0]))
+    for src, name in lost:
+        grab = queueFile(q, "claimed", name + ".recover-" + workerId())
+        try:
+            os.rename(queueFile(q, "claimed", src), grab)
+        except OSError:
+            continue	# finished, or another worker is recovering it
+        try:
+            os.remove(leasePath(q, name))
+        except OSError:
+            pass
+        try:
+            job = readJob(grab)
+        except (OSError, ValueError):
+            job = {"id": name[:-len(".json")]}
+        job["attempts"] = job.get("attempts", 0) + 1
+        if job["attempts"] >= maxattempts:
+            job["error"] = "lease expired " + str(job["attempts"]) + " times"
+            Message_Error("   " + job.get("id", name) + ": " + job["error"] + ", giving up")
+            writeJob(q, "failed", name, job)
+        else:
+            Message_Warning("   " + job.get("id", name) + ": lease expired, back to pending (attempt " + str(job["attempts"] + 1) + ")")
+            writeJob(q, "pending", name, job)
+        os.remove(grab)
+
+# move the first pending job we can win into claimed/, returns (name, job) or (None, None)
+def claimJob(q):
+    for name in queueJobs(q, "pending"):
+        try:
+            os.rename(queueFile(q, "pending", name), queueFile(q, "claimed", name))
+        except OSError:
+            continue	# another worker was faster
+        with open(leasePath(q, name), "w") as fh:
+            fh.write(workerId() + "\n")
+        try:
+            return name, readJob(queueFile(q, "claimed", name))
+        except (OSError, ValueError) as e:
+            Message_Error("   " + name + " is not a valid job: " + str(e))
+            os.replace(queueFile(q, "claimed", name), queueFile(q, "failed", name))
+            os.remove(leasePath(q, name))
+    return None, None
+
+# the branch, build and buildenv of a job: the enqueue options (fields, None
+# when not given) and what its JSON configuration sets for the others, as an
+# export prefers the arguments over the settings
+def queueJobFields(config,fields):
+    try:
+        with open(config, "rt", encoding="utf8") as r:
+            data = json.load(r)
+    except (OSError, ValueError) as e:
+        Message_Warning("   " + config + " can not be read (" + str(e) + "), using the enqueue options")
+        data = {}
+    settings = data.get("settings") or {}
+    example = data.get("useExample") or {}
+    return {
+        "branch": fields["branch"] or example.get("branch"),
+        "build": fields["build"] if fields["build"] is not None else settings.get("build"),
+        "buildenv": fields["buildenv"] or settings.get("buildenv")}
+
+# the export options of a job: its args, with its branch, build and buildenv
+# fields in place of the same options, so a job file can be written by hand
+def queueJobArgs(job):
+    args = list(job.get("args", []))
+    for field in ["branch", "build", "buildenv"]:
+        if job.get(field) is not None:
+            if "--" + field in args:
+                i = args.index("--" + field)
+                del args[i:i + 2]
+            args += ["--" + field, str(job[field])]
+    return args
+
+# run a claimed job while keeping its lease alive, then file it under done/ or failed/
+def runQueueJob(q,name,job,commit):
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(leasetime / 3.0):
+            try:
+                os.utime(leasePath(q, name))
+            except OSError:
+                return	# taken back by another worker
+    threading.Thread(target=heartbeat, daemon=True).start()
+    jobid = job.get("id", name[:-len(".json")])
+    target = job.get("target") or jobid
+    args = queueJobArgs(job)
+    try:
+        if commit is None and "--build" in args and args[args.index("--build") + 1] == "True":
+            result = {"job": job.get("config"), "name": target, "status": "failed", "seconds": 0, "artifacts": [], "error": "building needs --marlin on the worker"}
+        else:
+            result = runFleetJob(job.get("config"), target, commit, os.path.join(q, "results"), args, queueFile(q, "logs", target + ".log"))
+    finally:
+        stop.set()
+    job["worker"] = workerId()
+    job["finished"] = int(time.time())
+    job["result"] = result
+    ok = result["status"] == "ok"
+    writeJob(q, "done" if ok else "failed", name, job)
+    if not isFile(queueFile(q, "claimed", name)):
+        Message_Warning("   " + jobid + ": the lease was lost while running, the job may run again")
+    else:
+        for f in [queueFile(q, "failed" if ok else "done", name), queueFile(q, "claimed", name), leasePath(q, name)]:
+            try:
+                os.remove(f)	# and the result of an earlier attempt
+            except OSError:
+                pass
+    return result
+
+# claim and run jobs until the queue is empty and no other worker is running one
+def workerLoop(q,commit,results):
+    while True:
+        recoverJobs(q)
+        name, job = claimJob(q)
+        if name is None:
+            if not queueJobs(q, "claimed") and not glob.glob(queueFile(q, "claimed", "*.json.recover-*")):
+                return
+            time.sleep(queuepoll)
+            continue
+        result = runQueueJob(q, name, job, commit)
+        results.append(result)
+        msg = "   " + result["name"] + ": " + result["status"] + " in " + str(result["seconds"]) + "s"
+        if result["status"] == "ok":
+            Message_Config(msg)
+        else:
+            Message_Error(msg + " see " + queueFile(q, "logs", result["name"] + ".log"))
+        metricInc("fleet_jobs_total", 1, {"status": result["status"]})
+
+# --opmode enqueue. fields are the enqueue --branch, --build and --buildenv
+def runEnqueue(source,q,passargs,fields):
+    logger.debug("runEnqueue()")
+    if source == 'None' or q == 'None':
+        ExitStageLeft(400,"--opmode enqueue needs --source (a JSON configuration or a directory of them) and --queue")
+    jobs = findFleetJobs(source)
+    if not jobs:
+        ExitStageLeft(404,"No JSON configurations found in " + source)
+    for d in queuedirs:
+        os.makedirs(os.path.join(q, d), exist_ok=True)
+    Message_Header("Queueing " + str(len(jobs)) + " jobs in " + q)
+    names = set()
+    for job in jobs:
+        name = fleetJobName(job, source, names)
+        data = {"id": name, "config": job, "target": name, "args": passargs, "attempts": 0, "enqueued": int(time.time())}
+        data.update(queueJobFields(job, fields))
+        writeJob(q, "pending", name + ".json", data)
+        Message_Config("   " + name + ": " + job + (" (" + data["branch"] + ")" if data["branch"] else ""))
+
+# --opmode worker
+def runWorker(q,workers):
+    logger.debug("runWorker()")
+    if q == 'None':
+        ExitStageLeft(400,"--opmode worker needs --queue (the shared queue directory)")
+    if not storeEnabled():
+        ExitStageLeft(400,"--opmode worker keeps its target directories in the cache, --cachedir can not be None")
+    for d in queuedirs:
+        os.makedirs(os.path.join(q, d), exist_ok=True)
+    commit = None
+    if marlinrepo != 'None':
+        if not isDir(os.path.join(marlinrepo, ".git")) and not isFile(os.path.join(marlinrepo, ".git")):
+            ExitStageLeft(400,"--marlin must point at a local Marlin git clone")
+        commit = getMarlinCommit(marlinrepo)
+    if workers < 1:
+        workers = getFleetWorkers(max(1, len(queueJobs(q, "pending"))))
+    Message_Header("Worker " + workerId() + ": " + q + " with " + str(workers) + " parallel jobs" + (", Marlin " + commit[:12] if commit else ""))
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(workerLoop, q, commit, results) for i in range(workers)]:
+            future.result()
+    releaseFleetSlots()
+    failed = len([r for r in results if r["status"] != "ok"])
+    Message_Config("   " + str(len(results)) + " jobs run, " + str(failed) + " failed")
+    if failed:
+        ExitStageLeft(1,str(failed) + " of " + str(len(results)) + " jobs failed on this worker")
+
+#####################################################
+##### FUNCTIONS - FLEET DATABASE
+#####################################################
+# every export records the resulting state of each directive in cachedir/fleet.db
+# (sqlite), replacing the previous state of the same JSON configuration, so
+# fleet wide questions are answered from an index instead of grepping headers:
+#   --opmode query --query S_CURVE_ACCELERATION
+
+fleetdbversion = 1					# bump when the schema changes, the database is rebuilt by the next runs
+
+fleetdbschema = """
+CREATE TABLE IF NOT EXISTS printers (
+    config TEXT PRIMARY KEY,		-- absolute path of the JSON configuration
+    target TEXT,
+    branch TEXT,
+    commit_sha TEXT,
+    path TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS directives (
+    config TEXT NOT NULL,
+    file TEXT NOT NULL,
+    name TEXT NOT NULL,
+    enabled INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (config, file, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS directives_name ON directives (name, enabled);
+"""
+
+def fleetDBPath():
+    return os.path.join(cachedir, "fleet.db")
+
+# open (and create or upgrade) the fleet database. parallel runs wait for each other's writes
+def openFleetDB():
+    os.makedirs(cachedir, exist_ok=True)
+    db = sqlite3.connect(fleetDBPath(), timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    if db.execute("PRAGMA user_version").fetchone()[0] != fleetdbversion:
+        with db:
+            db.execute("DROP TABLE IF EXISTS directives")
+            db.execute("DROP TABLE IF EXISTS printers")
+            db.execute("PRAGMA user_version = " + str(fleetdbversion))
+    db.executescript(fleetdbschema)
+    return db
+
+# record the directives of the generated configuration files
+def recordDirectives():
+    logger.debug("recordDirectives()")
+    if not storeEnabled():
+        return
+    config = os.path.abspath(JSONFile)
+    rows = []
+    for f in [f_config, f_config_adv]:
+        if not isFileStaged(f):
+            continue
+        # the generated files are not worth a cache entry, they change with every option
+        for name, state in directiveStates(parseDirectives(readFile(f))).items():
+            rows.append((config, os.path.basename(f), name, int(state[0]), state[1]))
+    try:
+        db = openFleetDB()
+        try:
+            with db:
+                db.execute("DELETE FROM directives WHERE config = ?", (config,))
+                db.executemany("INSERT OR REPLACE INTO directives VALUES (?,?,?,?,?)", rows)
+                db.execute("INSERT OR REPLACE INTO printers VALUES (?,?,?,?,?,?)", (config, os.path.abspath(targetdir), branch, examplecommit, path, time.time()))
+        finally:
+            db.close()
+        Message_Debug("   Recorded " + str(len(rows)) + " directives in " + fleetDBPath())
+    except sqlite3.Error as e: ##error message
+        Message_Warning("   Unable to record the directives in " + fleetDBPath() + ": " + str(e))
+        logger.exception(e)
+
+# print the state of a directive (* and ? are wildcards) in every recorded configuration
+def runQuery():
+    logger.debug("runQuery()")
+    if query == 'None':
+        ExitStageLeft(400,"--opmode query needs --query DIRECTIVE")
+    if not isFile(fleetDBPath()):
+        ExitStageLeft(404,"No configurations recorded yet in " + fleetDBPath() + ". Export (or run a fleet) first.")
+    start = time.monotonic()
+    db = openFleetDB()
+    try:
+        rows = db.execute("SELECT p.config, d.name, d.enabled, d.value, d.file, p.branch, p.path FROM directives d JOIN printers p ON p.config = d.config WHERE d.name GLOB ? ORDER BY d.name, p.config, d.file", (query,)).fetchall()
+        total = db.execute("SELECT COUNT(*) FROM printers").fetchone()[0]
+    finally:
+        db.close()
+    Message_Header(query + " in " + str(len(set(r[0] for r in rows))) + " of " + str(total) + " recorded configurations (" + str(round((time.monotonic() - start) * 1000, 1)) + " ms)")
+    if not rows:
+        Message_Warning("   No recorded configuration has " + query)
+    width = max([len(os.path.relpath(r[0])) for r in rows] + [0])
+    for config, name, enabled, value, file, b, p in rows:
+        state = ("enabled" if enabled else "disabled") + (" " + value if value else "")
+        Message_Config("   " + os.path.relpath(config).ljust(width) + "  " + name + "  " + state + "  (" + file + ", " + str(b) + ":" + str(p) + ")")
+
+#####################################################
+##### FUNCTIONS - DIRECTIVE HISTORY
+#####################################################
+# an index of the stock Configuration.h/_adv.h of every release tag of a local
+# Marlin (or Configurations) clone: when each directive first and last appeared
+# and how its default changed. only tags that are not in the index yet are read,
+# and every distinct (name, enabled, value) is stored once with each tag keeping
+# an array of state ids, so the index stays small.
+#   --opmode history --marlin path/to/Marlin --query NAME
+#   --opmode history --marlin path/to/Marlin --source old/Configuration.h
+
+historyversion = 2					# bump when the index layout changes to rebuild it
+historyprefixes = ["Marlin/", "config/default/"]	# where a tag keeps its configuration files
+history = None						# the loaded index, see getHistoryIndex()
+
+def historyPath(repo):
+    return os.path.join(cachedir, "history", hashData(os.path.abspath(repo).encode("utf8"))[:16] + ".bin")
+
+# sort key of a release tag: its numbers, so 2.0.10 comes after 2.0.9.3
+def versionKey(tag):
+    return ([int(n) for n in re.findall("[0-9]+", tag)], tag)
+
+# release tags of a clone, oldest first
+def releaseTags(repo):
+    r = git(["tag", "--list"], repo)
+    if r.returncode != 0:
+        ExitStageLeft(500,"Unable to list the tags of " + repo + ": " + r.stderr.strip())
+    return sorted([t for t in r.stdout.split() if re.search("[0-9]+[.][0-9]+", t)], key=versionKey)
+
+# read many "tag:path" blobs with one git process, None for the missing ones
+def readBlobs(repo,specs):
+    r = subprocess.run(["git", "cat-file", "--batch"], cwd=repo, input="".join(spec + "\n" for spec in specs).encode("utf8"), capture_output=True)
+    blobs = []
+    pos = 0
+    for spec in specs:
+        end = r.stdout.index(b"\n", pos)
+        header = r.stdout[pos:end].split()
+        pos = end + 1
+        if len(header) < 3 or header[1] != b"blob":
+            blobs.append(None)
+            continue
+        size = int(header[2])
+        blobs.append(r.stdout[pos:pos + size].decode("utf8", "replace"))
+        pos += size + 1
+    return blobs
+
+# merged directive states of the configuration files of some tags, {tag: states}
+def tagStates(repo,tags):
+    specs = []
+    for tag in tags:
+        for prefix in historyprefixes:
+            for name in configfiles:
+                specs.append(tag + ":" + prefix + name)
+    blobs = readBlobs(repo, specs)
+    states = {}
+    per = len(historyprefixes) * len(configfiles)
+    for i, tag in enumerate(tags):
+        texts = []
+        for j in range(len(historyprefixes)):
+            found = [b for b in blobs[i * per + j * len(configfiles):i * per + (j + 1) * len(configfiles)] if b is not None]
+            if found:
+                texts = found
+                break
+        if texts:
+            states[tag] = fileStates(texts)
+    return states
+
+# load the index of a clone and add the tags it does not have yet
+def getHistoryIndex(repo):
+    logger.debug("getHistoryIndex()")
+    global history
+    indexfile = historyPath(repo)
+    index = {"version": historyversion, "repo": os.path.abspath(repo), "states": [], "tags": {}}
+    try:
+        with open(indexfile, "rb") as r:
+            cached = marshal.loads(r.read())
+        if cached.get("version") == historyversion:
+            index = cached
+    except (OSError, ValueError, EOFError, TypeError, AttributeError):
+        pass
+
+    tags = releaseTags(repo)
+    new = [t for t in tags if t not in index["tags"]]
+    if new:
+        start = time.monotonic()
+        ids = dict((tuple(st), i) for i, st in enumerate(index["states"]))
+        for n in range(0, len(new), 16):
+            for tag, states in tagStates(repo, new[n:n + 16]).items():
+                row = array.array("I")
+                for name, state in states.items():
+                    key = (name, state[0], state[1])
+                    if key not in ids:
+                        ids[key] = len(index["states"])
+                        index["states"].append(key)
+                    row.append(ids[key])
+                index["tags"][tag] = array.array("I", sorted(row)).tobytes()
+        Message_Config("   Indexed " + str(len(new)) + " new release tags of " + repo + " in " + str(round((time.monotonic() - start) * 1000)) + " ms")
+        os.makedirs(os.path.dirname(indexfile), exist_ok=True)
+        atomicWrite(indexfile, marshal.dumps(index))
+    index["order"] = sorted([t for t in index["tags"] if t in set(tags)], key=versionKey)
+    history = index
+    return index
+
+# the cached index of the --marlin clone without touching git, for hints in
+# messages. {} without --marlin, the index of another clone may not apply
+def loadRepoHistory():
+    global history
+    if history is None:
+        history = {}
+        if marlinrepo != 'None' and storeEnabled():
+            try:
+                with open(historyPath(marlinrepo), "rb") as r:
+                    cached = marshal.loads(r.read())
+                if cached.get("version") == historyversion:
+                    cached["order"] = sorted(cached["tags"], key=versionKey)
+                    history = cached
+            except (OSError, ValueError, EOFError, TypeError, AttributeError):
+                pass
+    return history
+
+# whether a sorted array holds a value
+def inSorted(row,value):
+    pos = bisect.bisect_left(row, value)
+    return pos < len(row) and row[pos] == value
+
+# [(tag, (enabled, value) or None)] of a directive, oldest first
+def directiveHistory(index,name):
+    ids = dict((i, st) for i, st in enumerate(index["states"]) if st[0] == name)
+    result = []
+    for tag in index["order"]:
+        row = array.array("I")
+        row.frombytes(index["tags"][tag])
+        hit = [i for i in ids if inSorted(row, i)]
+        result.append((tag, ids[hit[0]][1:] if hit else None))
+    return result
+
+# names that first appeared in a tag, the likely new names of a directive removed there
+def renamedTo(index,name,tag):
+    pos = index["order"].index(tag)
+    if pos == 0:
+        return []
+    names = lambda t: set(index["states"][i][0] for i in array.array("I", index["tags"][t]))
+    return difflib.get_close_matches(name, sorted(names(tag) - names(index["order"][pos - 1])), 3, 0.5)
+
+# one line summary of the history of a directive, "" if it is not in the index
+def historyNote(name):
+    index = loadRepoHistory()
+    if not index or not index.get("order"):
+        return ""
+    present = [tag for tag, state in directiveHistory(index, name) if state is not None]
+    if not present:
+        return ""
+    note = name + " was in releases " + present[0] + " to " + present[-1]
+    later = index["order"][index["order"].index(present[-1]) + 1:]
+    if later:
+        note += ", removed in " + later[0]
+        renames = renamedTo(index, name, later[0])
+        if renames:
+            note += " (renamed to " + " or ".join(renames) + "?)"
+    return note + "."
+
+# --opmode history
+def runHistory(source):
+    logger.debug("runHistory()")
+    if marlinrepo == 'None':
+        ExitStageLeft(400,"--opmode history needs --marlin (a local Marlin or Configurations git clone)")
+    if query == 'None' and source == 'None':
+        ExitStageLeft(400,"--opmode history needs --query DIRECTIVE or --source (a header to date)")
+    index = getHistoryIndex(marlinrepo)
+    if not index["order"]:
+        ExitStageLeft(404,"No release tags with configuration files found in " + marlinrepo)
+
+    if query != 'None':
+        start = time.monotonic()
+        changes = []
+        previous = None
+        for tag, state in directiveHistory(index, query):
+            if state != previous:
+                changes.append((tag, state))
+            previous = state
+        Message_Header("History of " + query + " over " + str(len(index["order"])) + " releases (" + str(round((time.monotonic() - start) * 1000, 1)) + " ms)")
+        if not [c for c in changes if c[1] is not None]:
+            Message_Warning("   " + query + " is in none of the releases. Close names: " + ", ".join(difflib.get_close_matches(query, sorted(set(st[0] for st in index["states"])), 5, 0.6)))
+        for tag, state in changes:
+            if state is None:
+                if tag != index["order"][0]:
+                    renames = renamedTo(index, query, tag)
+                    Message_Warning("   " + tag.ljust(16) + "removed" + (" (renamed to " + " or ".join(renames) + "?)" if renames else ""))
+                continue
+            Message_Config("   " + tag.ljust(16) + stateText(state))
+        note = historyNote(query) if history is index else ""
+        if note:
+            Message_Config("   " + note)
+
+    if source != 'None':
+        # the releases whose directive names are closest to the header(s)
+        texts = []
+        for f in extractSources(source):
+            with open(f, encoding="utf8", errors="replace") as r:
+                texts.append(r.read())
+        names = set(fileStates(texts))
+        scores = []
+        for tag in index["order"]:
+            tagnames = set(index["states"][i][0] for i in array.array("I", index["tags"][tag]))
+            scores.append((len(names & tagnames) / max(1, len(names | tagnames)), tag))
+        Message_Header("Releases closest to " + source)
+        for score, tag in sorted(scores, key=lambda x: (-x[0], versionKey(x[1])))[:5]:
+            Message_Config("   " + tag.ljust(16) + str(round(score * 100, 1)) + "% of the directive names in common")
+
 #####################################################
 ##### MAIN
 #####################################################
@@ -1034,6 +4137,20 @@ def main(args):
     global targetdir
     global path # Creality/CR-10 S5/CrealityV1
     global branch # bugfix-2.0.x
+    global metricsfile
+    global cachedir
+    global query
+    global build
+    global buildenv
+    global buildcmd
+    global marlinrepo
+    global gitreset
+    global updatelock
+    global stream
+    global archive
+    global distance
+    global leasetime
+    global lockfile
     opmode = "export"
 
     print()
@@ -1053,7 +4170,89 @@ def main(args):
     getDefaults()   # get default values for globals
     JSONFile = str(args.config)
     Message_Header("Using " + JSONFile)
-    getJSONSettings()
+    timePhase("settings", getJSONSettings)
+    if str(args.metrics) != 'None':
+        metricsfile = str(args.metrics)
+    if str(args.cachedir) != 'None':
+        cachedir = str(args.cachedir)
+    if str(args.query) != 'None':
+        query = str(args.query)
+    if str(args.build) != 'None':
+        build = eval(args.build)
+    if str(args.buildenv) != 'None':
+        buildenv = str(args.buildenv)
+    if str(args.buildcmd) != 'None':
+        buildcmd = str(args.buildcmd)
+    if str(args.reset) != 'None':
+        gitreset = eval(args.reset)
+    if str(args.stream) != 'None':
+        stream = eval(args.stream)
+    if int(args.distance) > 0:
+        distance = int(args.distance)
+    if int(args.lease) > 0:
+        leasetime = int(args.lease)
+    if str(args.output_archive) != 'None':
+        archive = str(args.output_archive)
+        if stream:
+            Message_Warning("--stream writes to the target directory and is ignored with --output-archive.")
+            stream = False
+    updatelock = eval(args.update_lock)
+
+    ##### operating modes other than exporting a configuration
+    opmode = str(args.opmode)
+    if opmode == "search":
+        if JSONFile != 'None':
+            getJSONConfig()
+        if str(args.branch) != 'None':
+            branch = str(args.branch)
+        timePhase("search", runSearch)
+        outro()
+    if opmode == "extract":
+        if JSONFile != 'None':
+            getJSONConfig()
+        if str(args.importpath) != 'None':
+            importpath = str(args.importpath)
+        timePhase("extract", lambda: runExtract(str(args.source), str(args.output)))
+        outro()
+    if opmode == "rebase":
+        if JSONFile != 'None':
+            getJSONConfig()
+        if str(args.importpath) != 'None':
+            importpath = str(args.importpath)
+        timePhase("rebase", lambda: runRebase(str(args.source), str(args.onto), str(args.output)))
+        outro()
+    if opmode in ["fleet", "enqueue", "worker"]:
+        if str(args.marlin) != 'None':
+            marlinrepo = str(args.marlin)
+        passargs = ["--missing", str(args.missing)]
+        if int(args.distance) > 0:
+            passargs += ["--distance", str(args.distance)]
+        # a queued job keeps branch, build and buildenv in fields of its own
+        fields = {"branch": None, "build": None, "buildenv": None}
+        for arg in ['branch', 'build', 'buildenv', 'buildcmd']:
+            if str(getattr(args, arg)) == 'None':
+                continue
+            if opmode == "enqueue" and arg in fields:
+                fields[arg] = eval(args.build) if arg == 'build' else str(getattr(args, arg))
+            elif arg != 'branch':
+                passargs += ["--" + arg, str(getattr(args, arg))]
+        if opmode == "fleet":
+            timePhase("fleet", lambda: runFleet(str(args.source), str(args.output), int(args.jobs), passargs))
+        elif opmode == "enqueue":
+            timePhase("enqueue", lambda: runEnqueue(str(args.source), str(args.queue), passargs, fields))
+        else:
+            timePhase("worker", lambda: runWorker(str(args.queue), int(args.jobs)))
+        outro()
+    if opmode == "query":
+        timePhase("query", runQuery)
+        outro()
+    if opmode == "history":
+        if str(args.marlin) != 'None':
+            marlinrepo = str(args.marlin)
+        timePhase("history", lambda: runHistory(str(args.source)))
+        outro()
+    if JSONFile == 'None':
+        ExitStageLeft(400,"--config JSON_CONFIG_FILE is required for --opmode " + opmode)
 
     ## boolean (assign directly to globals as an override)
     validate = eval(args.validate)
@@ -1067,12 +4266,27 @@ def main(args):
     args_prefer = str(args.prefer)
     args_JSONFile = str(args.config)
     args_importpath = str(args.importpath)
+    if str(args.marlin) != 'None':
+        marlinrepo = str(args.marlin)	# only for the history hints of missing directives
 
     # special processing for the target dir
     # default to user/branch/path(/Marlin)
     args_targetdir = str(args.target)
     if targetdir == 'None':
         targetdir = str("user/" + branch + "/" + path).replace(" ","_")
+
+    ##### JSON Example Configuration Information
+    # fetch the example in the background while any prompts below wait for an answer
+    timePhase("config", getJSONConfig)
+    # another branch of the same example, e.g. for a job of --opmode worker. the
+    # lockfile pins useExample.branch, so the other branch is used unpinned
+    if str(args.branch) != 'None' and str(args.branch) != branch:
+        branch = str(args.branch)
+        URL = exampleURL(branch,path)
+        lockfile = False
+        Message_Config("   Using branch " + branch + " instead of useExample.branch (not pinned by the lockfile)")
+    if not stream:
+        startPrefetch()	# it keeps the files in memory
     
     ##### resolve conficts
     # if there is a mode/prefer conflict we must resolve this regardless of any setting
@@ -1089,12 +4303,12 @@ def main(args):
     # resolve conflicts based on the mode we are in
     if mode == "interactive":
         if missing != args_missing:
-            missing = multi_choice_question(['add','skip'],'Add or Skip missing directives ? ','Settings Conflict --missing')    
+            missing = multi_choice_question(['add','skip','auto','fix'],'Add, Skip, Auto (add only directives Marlin uses), or Fix (use the closest name) missing directives ? ','Settings Conflict --missing')    
         if args_targetdir != 'None':
             if targetdir != args_targetdir:
                 targetdir = multi_choice_question([targetdir,args_targetdir],'Target Directory ? ','Settings Conflict --target')
                 marlindir = targetdir + "/Marlin"
-                if not isDir(marlindir):
+                if not isDir(marlindir) and archive == 'None':
                     Message_Warning('Target Directory " + marlindir + " does not exist.')
                     if not createdir:
                         Message_Warning('The --createdir option is disabled. This must be enabled to continue.')
@@ -1120,26 +4334,66 @@ def main(args):
         if prefer == "args":
             if args_missing != missing:
                 missing = args_missing
+            if args_targetdir != 'None':
+                targetdir = args_targetdir
+        marlindir = targetdir + "/Marlin"
+        if not isDir(marlindir) and archive == 'None':
+            if not createdir:
+                ExitStageLeft(404,"Target Directory " + marlindir + " does not exist. Use --createdir True to create it.")
+            Message_Config("Creating Target Directory: " + str(marlindir))
+            mkDir(marlindir)
 
-    ##### JSON Example Configuration Information
-    getJSONConfig()
+    ##### Put back the pristine configuration files the example does not overwrite
+    if gitreset:
+        timePhase("reset", resetConfigFiles)
 
     ##### Download Example Files from the Internet (if not using a local path)
-    getExampleFiles()
+    timePhase("fetch", getExampleFiles)
 
-    ##### Inject our header into the files to leave a footprint and help url
-    injectMetaHeader()
+    if stream:
+        ##### Stream the configuration files through the options, straight to disk
+        timePhase("options", getJSONOptions)
+        timePhase("stream", streamConfigFiles)
+        timePhase("commit", commitWrites)
+    else:
+        ##### Inject our header into the files to leave a footprint and help url
+        timePhase("metaheader", injectMetaHeader)
+
+        ##### Configuration Directives from JSON Configuration File
+        timePhase("options", getJSONOptions)
 
-    ##### Configuration Directives from JSON Configuration File
-    getJSONOptions()
+        ##### Update the Configuration (only the changed options if the example is the same as last time)
+        if archive != 'None' or not timePhase("delta", applyDelta):
+            if (len(options_enable) > 0):
+                timePhase("enable", enableDirectives)
+            if (len(options_disable) > 0):
+                timePhase("disable", disableDirectives)
+            if (len(options_values) > 0):
+                timePhase("values", updateValues)
+
+        ##### Write the changed files to disk (or into the archive)
+        if archive != 'None':
+            timePhase("archive", lambda: writeArchive(archive))
+        else:
+            timePhase("commit", commitWrites)
+            timePhase("manifest", writeManifest)
+            timePhase("record", recordDirectives)	# an archive is not a printer target
+    timePhase("store", storeFlush)
 
-    ##### Update the Configuration
-    if (len(options_enable) > 0):
-        enableDirectives()
-    if (len(options_disable) > 0):
-        disableDirectives()
-    if (len(options_values) > 0):
-        updateValues()
+    ##### Build the firmware (or reuse an identical build)
+    if build and archive != 'None':
+        Message_Warning("--build needs the files in the target directory and is skipped with --output-archive.")
+    elif build:
+        timePhase("build", buildFirmware)
+
+    ##### Keep applying the options as the JSON file is edited
+    if eval(args.watch):
+        if archive != 'None':
+            Message_Warning("--watch updates the target directory and is not available with --output-archive.")
+        elif stream:
+            Message_Warning("--watch keeps the configuration files in memory and is not available with --stream.")
+        else:
+            runWatch()
 
     ##### Exit gracefully
     outro()
@@ -1151,13 +4405,15 @@ def main(args):
 # parse out the args (also create --help output) and then pass to main function
 # https://docs.python.org/3/library/argparse.html
 if __name__ == "__main__":
-    intro()
     parser = argparse.ArgumentParser(description='Builds Configuration Files from Marlin Examples', conflict_handler='resolve', fromfile_prefix_chars='@')
 
     # files
-    parser.add_argument('--config', type=str, metavar="JSON_CONFIG_FILE", help='JSON Configuration File',default='None',required=True)
+    parser.add_argument('--config', type=str, metavar="JSON_CONFIG_FILE", help='JSON Configuration File. Required to export a configuration.',default='None')
     parser.add_argument('--importpath', type=str, metavar="SOURCE_CONFIG_PATH", help='Import a local config example path',default='None')
     parser.add_argument('--target', type=str, metavar="MARLIN_ROOT_DIR", help='The directory in which the files will be saved. Default is current directory. Usually this is the directory platformio.ini is in.',default='None')
+    parser.add_argument('--cachedir', type=str, metavar="CACHE_DIR", help='Directory of the local cache shared by all runs (example file store etc). Default: cache',default='None')
+    parser.add_argument('--output-archive', type=str, metavar="ARCHIVE", help='Write the generated files into this .tar, .tar.gz/.tgz or .zip instead of the target directory, or - for a tar on stdout. Entries are named <config>/<path in the target>.',default='None')
+    parser.add_argument('--metrics', type=str, metavar="PROM_FILE", help='Write run metrics to this Prometheus textfile-collector file (.prom) when the run ends.',default='None')
     
     # boolean
     parser.add_argument('--argsfile', type=str, help='Uses marlin-configurator.ini. !! Using this file overrides all other args on the command-line !!', choices=['True','False'], default='False')
@@ -1165,14 +4421,40 @@ if __name__ == "__main__":
     parser.add_argument('--validate', type=str, help='Validate JSON Configuration file syntax.', choices=['True','False'],default='False')
     parser.add_argument('--createdir', type=str, help='Creates the target directory if it does not exist.', choices=['True','False'],default='False')
     parser.add_argument('--silent', type=str, help='Suppress Configuration Change Information. Default: false', choices=['True','False'],default='False')
+    parser.add_argument('--watch', type=str, help='After exporting, keep running and re-apply the options each time the JSON configuration file is saved.', choices=['True','False'],default='False')
+
+    parser.add_argument('--stream', type=str, help='Stream Configuration.h/_adv.h line by line through the options straight to disk, for low memory hosts. Not recorded in the fleet database.', choices=['True','False'], default='None')
+    parser.add_argument('--update-lock', type=str, help='Pin the example to the current commit of its branch again and rewrite the lockfile next to --config.', choices=['True','False'], default='False')
+    parser.add_argument('--reset', type=str, help='Restore the configuration files of the target Marlin git checkout that differ from its commit before applying (replaces a whole-tree git reset --hard).', choices=['True','False'], default='None')
+
+    # firmware build
+    parser.add_argument('--build', type=str, help='Build the firmware after generating the configuration. Identical builds are reused from the cache.', choices=['True','False'], default='None')
+    parser.add_argument('--buildenv', type=str, metavar="PIO_ENV", help='PlatformIO environment to build.', default='None')
+    parser.add_argument('--buildcmd', type=str, metavar="COMMAND", help='Build command run in the target directory, {env} is replaced by --buildenv. Default: "pio run -e {env}"', default='None')
+
+    # operating mode
+    parser.add_argument('--opmode', type=str, help='export: build the configuration files (default). search: fuzzy search the example paths of a branch for --query. extract: write the JSON options that turn the stock example (--importpath or useExample in --config) into the headers in --source. fleet: generate (and --build) every JSON configuration in --source in parallel, each in its own git worktree of --marlin. query: show the state of directive --query in every configuration exported so far. rebase: three-way merge the customized headers in --source from the stock example (--importpath or useExample in --config) onto the new stock example --onto. history: when directive --query was in the releases of --marlin, or which release the header(s) in --source match best. enqueue: add every JSON configuration in --source as a job to the shared --queue directory. worker: run the jobs of --queue (with --marlin to build them) until it is empty; start one on every build node.', choices=['export','search','extract','fleet','query','rebase','history','enqueue','worker'], default='export')
+    parser.add_argument('--query', type=str, metavar="TEXT", help='Search text for --opmode search, e.g. "ender3 v2 skr". Directive name for --opmode query (* and ? are wildcards) and --opmode history.', default='None')
+    parser.add_argument('--source', type=str, metavar="PATH", help='--opmode extract: a modified Configuration.h/_adv.h, a directory with both, or a directory of printer directories. --opmode rebase: a printer directory or a directory of them. --opmode history: a header or printer directory to date. --opmode fleet: a JSON configuration or a directory of them.', default='None')
+    parser.add_argument('--output', type=str, metavar="PATH", help='--opmode extract: JSON file to write (default stdout), or the directory for many printers (default user/extracted). --opmode rebase: directory for the new headers and rebase.json (default user/rebased). --opmode fleet: directory for the headers, firmware and logs of each job (default fleet).', default='None')
+    parser.add_argument('--onto', type=str, metavar="EXAMPLE", help='--opmode rebase: the new stock example, a directory with its headers or a branch/commit of useExample.path (e.g. 2.1.x).', default='None')
+    parser.add_argument('--marlin', type=str, metavar="MARLIN_REPO", help='Local Marlin git clone used by --opmode fleet and history (a Configurations clone also works for history). An export uses its history index for hints on missing directives.', default='None')
+    parser.add_argument('--jobs', type=int, metavar="N", help='--opmode fleet and worker: number of parallel jobs. Default: as many as the cpus and memory allow.', default=0)
+    parser.add_argument('--queue', type=str, metavar="QUEUE_DIR", help='Shared queue directory for --opmode enqueue and worker (pending, claimed, done, failed, logs and results below it).', default='None')
+    parser.add_argument('--lease', type=int, metavar="SECONDS", help='--opmode worker: seconds without a heartbeat before the job of a lost worker is run again. Default: ' + str(leasetime), default=0)
+    parser.add_argument('--branch', type=str, metavar="BRANCH", help='Configurations branch for --opmode search, and of the example to export (instead of useExample.branch). --opmode enqueue: the branch of the jobs. Default: useExample.branch from --config or ' + branch, default='None')
 
     # behavioral preferences
     parser.add_argument('--prefer', type=str, help='Prefer either the JSON config, or the command-line when there is a conflict.', choices=['config','args'],default='args')
-    parser.add_argument('--missing', type=str, help='Add missing directives instead of skipping them. Default: skip.', choices=['add','skip'], default='skip')
+    parser.add_argument('--missing', type=str, help='Add missing directives instead of skipping them. auto adds them (to Configuration.h) only if the Marlin source in the target uses them and skips typos, without prompting. fix applies the option to the single closest directive name (within --distance edits) instead. Default: skip.', choices=['add','skip','auto','fix'], default='skip')
+    parser.add_argument('--distance', type=int, metavar="N", help='Max edits between a missing directive and a suggested one, also for --missing fix. Default: ' + str(distance), default=0)
     parser.add_argument('--mode', type=str, help='Batch mode will skip all prompts except preference. Interactive mode will present choices when conflicts arise.', choices=['batch','interactive'], default='interactive')
     
     # process args & read from conf file if set
     args = parser.parse_args()
+    if args.output_archive == "-":
+        sys.stdout = sys.stderr		# stdout carries the archive, everything else goes to stderr
+    intro()
     if (eval(args.argsfile)):
         Message_Warning("Using marlin-configurator.ini. All other passed arguments ignored.")
         args = parser.parse_args(['@marlin-configurator.ini'])
@@ -0,0 +1,196 @@
+#####################################################
+##### TESTS - marlin-configurator.py
+#####################################################
+# offline tests of the work queue, the build cache and a few regressions. the
+# example files are put in the store and pinned by a lockfile next to each JSON,
+# so no export touches the network. run with: python -m pytest -q tests
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "marlin-configurator.py")
+workdir = None
+mc = None
+
+def setUpModule():
+    global workdir, mc
+    # the script logs to marlin-configurator.log in the working directory
+    workdir = tempfile.mkdtemp(prefix="mc-test-")
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("marlin_configurator", script)
+    mc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mc)
+
+def tearDownModule():
+    os.chdir(os.path.dirname(script))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+stock = "".join("//#define OPT_%d %d\n" % (i, i) for i in range(50))
+stockadv = "".join("//#define ADV_%d\n" % i for i in range(20))
+
+# a directory with the script, a store holding the example and count pinned configurations
+def makeRoot(count):
+    root = tempfile.mkdtemp(prefix="root-", dir=workdir)
+    shutil.copy(script, root)
+    os.makedirs(os.path.join(root, "cfg"))
+    with mock.patch.object(mc, "cachedir", os.path.join(root, "cache")):
+        h1 = mc.storePut(stock.encode("utf8"))
+        h2 = mc.storePut(stockadv.encode("utf8"))
+        mc.storeFlush()
+    for i in range(count):
+        with open(os.path.join(root, "cfg", "p%d.json" % i), "w") as fh:
+            json.dump({"settings": {"mode": "batch", "missing": "skip"},
+                       "useExample": {"branch": "bugfix-2.0.x", "path": "Test/P", "files": ["Configuration.h", "Configuration_adv.h"]},
+                       "options": {"enable": ["OPT_%d" % i], "values": {"OPT_%d" % (i + 1): str(i * 10)}}}, fh)
+        with open(os.path.join(root, "cfg", "p%d.lock" % i), "w") as fh:
+            json.dump({"branch": "bugfix-2.0.x", "path": "Test/P", "commit": "a" * 40, "files": {"Configuration.h": h1, "Configuration_adv.h": h2}}, fh)
+    return root
+
+def run(root, *args):
+    return subprocess.run([sys.executable, "marlin-configurator.py"] + list(args), cwd=root, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+
+def response(code, body):
+    r = requests.Response()
+    r.status_code = code
+    r._content = body.encode("utf8")
+    r.request = requests.Request("GET", "http://localhost/").prepare()
+    return r
+
+class TestWorkQueue(unittest.TestCase):
+    def test_workers_share_a_queue(self):
+        root = makeRoot(6)
+        r = run(root, "--opmode", "enqueue", "--source", "cfg", "--queue", "queue", "--cachedir", "cache")
+        self.assertEqual(r.returncode, 0, r.stdout + r.stderr)
+        workers = [subprocess.Popen([sys.executable, "marlin-configurator.py", "--opmode", "worker", "--queue", "queue", "--jobs", "1", "--cachedir", "cache"],
+                                    cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL) for i in range(3)]
+        for w in workers:
+            self.assertEqual(w.wait(timeout=300), 0)
+        q = os.path.join(root, "queue")
+        self.assertEqual(sorted(os.listdir(os.path.join(q, "done"))), ["p%d.json" % i for i in range(6)])
+        self.assertEqual(os.listdir(os.path.join(q, "failed")), [])
+        self.assertEqual(os.listdir(os.path.join(q, "claimed")), [])
+        with open(os.path.join(q, "results", "p3", "Configuration.h"), encoding="utf8") as fh:
+            text = fh.read()
+        self.assertIn("\n#define OPT_3 3", text)
+        self.assertIn("\n#define OPT_4 30", text)
+
+    def test_enqueue_options_win(self):
+        root = makeRoot(1)
+        r = run(root, "--opmode", "enqueue", "--source", "cfg", "--queue", "queue", "--branch", "2.1.x", "--build", "False", "--cachedir", "cache")
+        self.assertEqual(r.returncode, 0, r.stdout + r.stderr)
+        with open(os.path.join(root, "queue", "pending", "p0.json"), encoding="utf8") as fh:
+            job = json.load(fh)
+        self.assertEqual((job["branch"], job["build"], job["target"]), ("2.1.x", False, "p0"))
+        args = mc.queueJobArgs(job)
+        self.assertEqual(args[args.index("--branch") + 1], "2.1.x")
+        self.assertEqual(args[args.index("--build") + 1], "False")
+        self.assertNotIn("--buildenv", args)
+
+    def test_recover_lost_jobs(self):
+        q = tempfile.mkdtemp(prefix="queue-", dir=workdir)
+        for d in mc.queuedirs:
+            os.makedirs(os.path.join(q, d))
+        # a job whose worker died, and one whose recovering worker died
+        for f, job in [("a.json", {"id": "a", "attempts": 0}), ("b.json.recover-gone-1", {"id": "b", "attempts": 2})]:
+            with open(os.path.join(q, "claimed", f), "w") as fh:
+                json.dump(job, fh)
+        time.sleep(1.2)
+        with mock.patch.object(mc, "leasetime", 1):
+            mc.recoverJobs(q)
+        self.assertEqual(os.listdir(os.path.join(q, "claimed")), [])
+        self.assertEqual(os.listdir(os.path.join(q, "pending")), ["a.json"])
+        with open(os.path.join(q, "failed", "b.json"), encoding="utf8") as fh:
+            self.assertEqual(json.load(fh)["attempts"], 3)
+
+@unittest.skipIf(shutil.which("git") is None, "needs git")
+class TestFleetSlots(unittest.TestCase):
+    def test_slots_are_locked_across_processes(self):
+        repo = tempfile.mkdtemp(prefix="marlin-", dir=workdir)
+        os.makedirs(os.path.join(repo, "Marlin"))
+        with open(os.path.join(repo, "Marlin", "Configuration.h"), "w") as fh:
+            fh.write(stock)
+        for args in [["init", "-q"], ["add", "."], ["-c", "user.email=t@t", "-c", "user.name=t", "commit", "-q", "-m", "stock"]]:
+            subprocess.run(["git"] + args, cwd=repo, check=True)
+        cache = os.path.join(repo, "..", os.path.basename(repo) + "-cache")
+        with mock.patch.object(mc, "cachedir", cache), mock.patch.object(mc, "marlinrepo", repo):
+            commit = mc.getMarlinCommit(repo)
+            ours = mc.getFleetSlot(commit)
+            # another process asks for a slot while we hold ours
+            code = "import importlib.util,sys;s=importlib.util.spec_from_file_location('m',%r);m=importlib.util.module_from_spec(s);s.loader.exec_module(m);m.cachedir=%r;m.marlinrepo=%r;print(m.getFleetSlot(%r))" % (script, cache, repo, commit)
+            other = subprocess.run([sys.executable, "-c", code], cwd=workdir, capture_output=True, text=True).stdout.strip().splitlines()[-1]
+            self.assertNotEqual(os.path.basename(ours), os.path.basename(other))
+            mc.releaseFleetSlots()
+            self.assertEqual(mc.fleetSlotLocks, {})
+
+class TestBuildCache(unittest.TestCase):
+    def test_identical_build_in_another_target_is_reused(self):
+        root = makeRoot(1)
+        stub = os.path.join(root, "stub.py")
+        with open(stub, "w") as fh:
+            fh.write("import os\nos.makedirs('.pio/build/stub', exist_ok=True)\nopen('.pio/build/stub/firmware.bin', 'w').write('fw')\nopen(%r, 'a').write('x')\n" % os.path.join(root, "builds"))
+        cmd = '"' + sys.executable + '" "' + stub + '"'
+        for target in ["t1", "t2"]:
+            r = run(root, "--config", "cfg/p0.json", "--target", target, "--force", "True", "--createdir", "True", "--cachedir", "cache", "--build", "True", "--buildenv", "stub", "--buildcmd", cmd)
+            self.assertEqual(r.returncode, 0, r.stdout + r.stderr)
+            self.assertTrue(os.path.isfile(os.path.join(root, target, ".pio", "build", "stub", "firmware.bin")))
+        with open(os.path.join(root, "builds")) as fh:
+            self.assertEqual(fh.read(), "x")
+
+    def test_build_key_ignores_the_meta_header(self):
+        keys = []
+        for target in ["a", "b"]:
+            t = os.path.join(workdir, "keys", target)
+            os.makedirs(os.path.join(t, "Marlin"), exist_ok=True)
+            with mock.patch.object(mc, "targetdir", t), mock.patch.object(mc, "files", ["Configuration.h"]), mock.patch.object(mc, "buildenv", "stub"):
+                with open(os.path.join(t, "Marlin", "Configuration.h"), "w") as fh:
+                    fh.write(mc.getMetaHeader() + "#define FOO 5\n")
+                keys.append(mc.getBuildKey())
+        self.assertEqual(keys[0], keys[1])
+
+class TestRegressions(unittest.TestCase):
+    def setUp(self):
+        mc.pendingWrites = {}
+
+    def test_404_body_is_never_a_file(self):
+        url = mc.rawurl + "bugfix-2.0.x/config/examples/Nope/Configuration.h"
+        with mock.patch.object(mc, "fetch", lambda *a, **k: response(404, "404: Not Found")), \
+             mock.patch.object(mc, "suggestExamplePaths", lambda: None), mock.patch.object(mc, "cachedir", "None"):
+            with mock.patch.object(mc, "mode", "batch"):
+                with self.assertRaises(SystemExit):
+                    mc.getWebFile(url)
+            with mock.patch.object(mc, "mode", "interactive"), mock.patch.object(mc, "multi_choice_question", lambda *a: "continue"):
+                self.assertIsNone(mc.getWebFile(url))
+        self.assertEqual(mc.pendingWrites, {})
+
+    def test_stream_with_reset_keeps_the_options(self):
+        t = os.path.join(workdir, "stream")
+        os.makedirs(os.path.join(t, "Marlin"), exist_ok=True)
+        src = os.path.join(workdir, "stream-src.h")
+        with open(src, "w") as fh:
+            fh.write("#define FOO 1\n//#define BAR\n")
+        config = os.path.join(workdir, "stream.json")
+        with open(config, "w") as fh:
+            json.dump({"options": {"enable": ["BAR"], "values": {"FOO": "5"}}}, fh)
+        with mock.patch.object(mc, "targetdir", t), mock.patch.object(mc, "JSONFile", config), mock.patch.object(mc, "cachedir", "None"), \
+             mock.patch.object(mc, "silent", True), mock.patch.object(mc, "stream", True):
+            mc.getJSONOptions()
+            mc.pendingWrites = {os.path.join(t, "Marlin", "Configuration.h"): "#define FOO 1\n//#define BAR\n"}	# staged by resetConfigFiles()
+            mc.streamed = {mc.f_config: (src, False)}
+            mc.streamConfigFiles()
+            mc.commitWrites()
+        with open(os.path.join(t, "Marlin", "Configuration.h"), encoding="utf8") as fh:
+            text = fh.read()
+        self.assertIn("\n#define FOO 5", text)
+        self.assertIn("\n#define BAR", text)
+
+if __name__ == "__main__":
+    unittest.main()